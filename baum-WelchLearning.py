@@ -16,8 +16,84 @@ emission probabilities Emission that maximizes Pr(x,π) over all possible
 transition and emission matrices and over all hidden paths π. 
 '''
 
+import os
 import sys
+import copy
+import json
+import time
+import multiprocessing
+from multiprocessing import shared_memory
 import numpy as np
+try:
+   import numba #optional, compiles the recursion loops
+except ImportError:
+   numba = None
+
+
+class CommandLine() :
+   '''
+   Handle the command line, usage and help requests.
+
+   CommandLine uses argparse to parse the options given on the command line.
+   The rosalind formatted input is still read from stdin.
+
+   attributes:
+   myCommandLine.args is a dictionary which includes each of the available
+   command line arguments as myCommandLine.args['option']
+   '''
+
+   def __init__(self, inOpts=None) :
+      '''
+      CommandLine constructor.
+      Implements a parser to interpret the command line argv string using argparse.
+      '''
+      import argparse
+      self.parser = argparse.ArgumentParser(
+         description = 'Baum-Welch learning of the transition and emission matrices of an HMM',
+         add_help = True, #default is True
+         prefix_chars = '-',
+         usage = '%(prog)s [options] < input > output'
+         )
+      self.parser.add_argument('-o', '--observation', default='', action = 'store',
+         help='memory map the observation from this file instead of the observation section of the input')
+      self.parser.add_argument('-p', '--processes', type=int, default=1, action = 'store',
+         help='number of worker processes sharing the E-step (default 1)')
+      self.parser.add_argument('--batch-size', type=int, default=1<<20, action = 'store',
+         help='the most padded positions (sequences x length) run through forward and backward together (default 1048576)')
+      self.parser.add_argument('-t', '--tolerance', type=float, default=None, action = 'store',
+         help='stop once the relative change in log-likelihood is below this')
+      self.parser.add_argument('-d', '--delta', type=float, default=None, action = 'store',
+         help='stop once no matrix entry changes by more than this')
+      self.parser.add_argument('-s', '--sparse', action = 'store_true', default = False,
+         help='multiply through only the nonzero transitions, for large mostly forbidden models')
+      self.parser.add_argument('--precision', type=int, default=64, choices=[32, 64], action = 'store',
+         help='bits of the floats of the matrices and forward and backward tables (default 64)')
+      self.parser.add_argument('--backend', default='auto', choices=['auto', 'numpy', 'numba'], action = 'store',
+         help='run the forward and backward recursions as NumPy calls or as Numba compiled loops (default numba when installed)')
+      self.parser.add_argument('--resume', default='', action = 'store',
+         help='start from the states, alphabet and matrices of this binary model, continuing its iteration count')
+      self.parser.add_argument('--save', default='', action = 'store',
+         help='write the learned model to this file in the binary model format')
+      self.parser.add_argument('--save-every', type=int, default=0, action = 'store',
+         help='also write the --save model after every this many iterations (or online updates), {0} in its name becomes the count')
+      self.parser.add_argument('-r', '--restarts', type=int, default=1, action = 'store',
+         help='train from this many initializations, the given matrices and random ones, and keep the best')
+      self.parser.add_argument('--seed', type=int, default=None, action = 'store',
+         help='seed of the random restarts')
+      self.parser.add_argument('--abort', type=float, default=0.01, action = 'store',
+         help='abandon a restart once its log-likelihood is this far (relative) behind the best at the same iteration (default 0.01)')
+      self.parser.add_argument('--online', default='', action = 'store',
+         help='train with online EM on each line of this file, a mini-batch at a time, instead of the observation section')
+      self.parser.add_argument('--minibatch', type=int, default=100, action = 'store',
+         help='observations in each online update (default 100)')
+      self.parser.add_argument('--alpha', type=float, default=0.6, action = 'store',
+         help='the online step size is (updates+2)^-alpha (default 0.6)')
+      self.parser.add_argument('--trace', default=None, action = 'store',
+         help='write the log-likelihood, time and change of each iteration to this file as JSON')
+      if inOpts is None :
+         self.args = vars(self.parser.parse_args())
+      else :
+         self.args = vars(self.parser.parse_args(inOpts))
 
 
 class FileReader :
@@ -58,51 +134,419 @@ class FileReader :
       return matrices
 
 
+class Observation :
+   '''
+   Note:
+      Encodes an observation into the alphabet index of each symbol once,
+      through a 256 entry lookup table applied to the raw bytes, so the same
+      codes can be reused by every decoding and training call. A file is
+      read through a memory map, whitespace and newlines are skipped
+   Args:
+      alphabet: a list of the single character symbols of a hmm
+      observation: a string or bytes of the observed symbols
+      fname: a file of observed symbols to memory map instead
+   Returns:
+      codes: an array of the alphabet index of each symbol
+   '''
+
+   def __init__ (self, alphabet, observation='', fname='') :
+      '''
+      Builds the lookup table and encodes the observation or file
+      '''
+      self.alphabet = alphabet
+      codeType = np.uint8 if len(alphabet) < 254 else np.uint16
+      self.bad = np.iinfo(codeType).max
+      self.space = self.bad - 1
+      self.lookup = np.full(256, self.bad, dtype=codeType)
+      for i, symbol in enumerate(alphabet):
+         self.lookup[ord(symbol)] = i
+      for symbol in b' \t\r\n':
+         self.lookup[symbol] = self.space
+
+      if fname != '':
+         observation = np.memmap(fname, np.uint8, 'r') if os.path.getsize(fname) else b''
+      self.codes = self.encode(observation)
+
+
+   def __len__ (self) :
+      '''the number of symbols'''
+      return len(self.codes)
+
+
+   def encode (self, raw, chunkSize=1<<24) :
+      '''
+      Returns the alphabet index of each symbol of a string, bytes or byte
+      array, looked up a chunk at a time so a memory mapped file is never
+      copied whole
+      '''
+      if isinstance(raw, str):
+         raw = raw.encode()
+      if isinstance(raw, bytes):
+         raw = np.frombuffer(raw, np.uint8)
+      pieces = []
+      for start in range(0, len(raw), chunkSize):
+         codes = self.lookup[raw[start:start + chunkSize]]
+         codes = codes[codes != self.space]
+         if (codes == self.bad).any():
+            raise ValueError('observation has a symbol not in the alphabet')
+         pieces.append(codes)
+      if not pieces:
+         return np.zeros(0, self.lookup.dtype)
+      return np.concatenate(pieces)
+
+
+class ModelFile :
+   '''
+   Note:
+      A versioned binary HMM. The file starts with the magic HMMBIN, a
+      uint16 version and the uint32 length of a JSON header holding the
+      states, alphabet, training metadata and the offset and shape of each
+      array. The float64 arrays follow, each on a 64 byte boundary, so they
+      are memory mapped by read instead of parsed or copied
+   Args:
+      fname: the model file
+   Returns:
+      read fills states, alphabet, transition, emission, initial (None when
+      the model has none) and metadata
+   '''
+
+   magic = b'HMMBIN'
+   version = 1
+
+   def __init__ (self, fname) :
+      '''constructor: saves attribute fname'''
+      self.fname = fname
+      self.initial = None
+      self.metadata = {}
+
+
+   def isModel (self) :
+      '''
+      Returns whether the file starts with the magic of a binary model
+      '''
+      with open(self.fname, 'rb') as fileH:
+         return fileH.read(len(self.magic)) == self.magic
+
+
+   def read (self) :
+      '''
+      Reads the header and maps the arrays, returns self
+      '''
+      with open(self.fname, 'rb') as fileH:
+         prefix = fileH.read(len(self.magic) + 6)
+         if prefix[:len(self.magic)] != self.magic:
+            raise ValueError('{0} is not a binary model'.format(self.fname))
+         version, headerLen = np.frombuffer(prefix[len(self.magic):], dtype='<u2,<u4')[0].tolist()
+         if version > self.version:
+            raise ValueError('{0} is model version {1}, this reads up to {2}'.format(self.fname, version, self.version))
+         header = json.loads(fileH.read(headerLen))
+      self.states = header['states']
+      self.alphabet = header['alphabet']
+      self.metadata = header.get('metadata', {})
+      base = -(-(len(self.magic) + 6 + headerLen)//64)*64
+      for name, (offset, shape) in header['arrays'].items():
+         setattr(self, name, np.memmap(self.fname, '<f8', 'r', base + offset, tuple(shape)))
+      return self
+
+
+   def write (self, states, alphabet, transition, emission, initial=None, metadata=None) :
+      '''
+      Writes a model, through a temporary file that replaces fname so a
+      checkpoint being written never leaves a partial model behind
+      '''
+      arrays = {'transition': transition, 'emission': emission}
+      if initial is not None:
+         arrays['initial'] = initial
+      layout = {}
+      offset = 0
+      for name, array in arrays.items():
+         layout[name] = (offset, list(np.shape(array)))
+         offset += -(-np.size(array)*8//64)*64
+      header = json.dumps({'states': list(states), 'alphabet': list(alphabet),
+         'arrays': layout, 'metadata': metadata or {}}).encode()
+      prefix = self.magic + np.array([(self.version, len(header))], dtype='<u2,<u4').tobytes() + header
+      base = -(-len(prefix)//64)*64
+
+      temp = self.fname + '.tmp'
+      with open(temp, 'wb') as fileH:
+         fileH.write(prefix + bytes(base - len(prefix)))
+         for name, array in arrays.items():
+            fileH.seek(base + layout[name][0])
+            fileH.write(np.ascontiguousarray(array, '<f8').tobytes())
+      os.replace(temp, self.fname)
+
+
 class HMM:
    '''
    Notes:
       MaxE modeled after Baum Welch found on stack overflow
    Args:
-      iteration: an int for the number of iteraions
-      observation: a string of the observation
+      iteration: an int for the number of iteraions, the cap when a
+         tolerance is given
+      observation: a string or Observation of the observation, or a list of
+         them for independent sequences trained together
       alphabet: a list of the alphabet in a hmm
       states: a list of the states in a hmm
       transitionMatrixList: a list of lists containing the transition matrix
       emissionMatrixList: a list of lists containing the emission matrix
+      batchSize: the most padded positions (sequences x length) run through
+         forward and backward together
+      processes: the number of worker processes the batches are shared
+         between in each E-step. With more than one, the batches are also
+         capped at an equal share of the positions, so there are at least
+         as many batches as processes unless a single sequence is longer
+      tolerance: stop once the relative change in log-likelihood between
+         iterations is below this
+      delta: stop once no entry of either matrix changes by more than this
+      sparse: run the recursions and transition counts through only the
+         nonzero transitions with a SparseTransition
+      initial: the starting probability of each state, equal when None. It
+         is kept as it is, only the matrices are learned
+      dtype: the float type of the matrices and the forward and backward
+         tables, np.float32 halves their memory. Counts and log-likelihoods
+         are still added up in double precision
+      save: a file the model is written to every saveEvery iterations
+      saveEvery: how often to checkpoint the model, 0 for never
+      backend: the kernels that run the forward and backward recursions,
+         see chooseKernels
    Returns:
    A matrix of transition probabilities and a matrix of emission probabilities
    '''
 
-   def __init__(self, iteration, observation, alphabet, states, transitionMatrixList, emissionMatrixList) :
+   def __init__(self, iteration, observation, alphabet, states, transitionMatrixList, emissionMatrixList, batchSize=1<<20, processes=1, tolerance=None, delta=None, sparse=False, initial=None, save='', saveEvery=0, dtype=np.float64, backend='auto') :
       '''
       Stores iteration, observation, alphabet, states and then builds the matrices
+      and the padded batches of the observations
       '''
       self.iteration = iteration
       self.observation = observation
       self.alphabet = alphabet
       self.states = states
+      self.dtype = np.dtype(dtype)
       self.transition = self.buildMatrix(transitionMatrixList)
       self.emission = self.buildMatrix(emissionMatrixList)
-      self.observationIndex = self.convertObservation()
-      self.len = len(self.observation)
+      self.initial = np.full(len(states), 1/len(states), self.dtype) if initial is None else np.asarray(initial, self.dtype)
+      if isinstance(observation, (str, Observation)):
+         observation = [observation]
+      self.encoder = Observation(alphabet)
+      self.observationIndex = [self.convertObservation(i) for i in observation if len(i) > 0]
+      self.batchSize = batchSize
+      self.processes = processes
+      if processes > 1:
+         positions = sum(len(i) for i in self.observationIndex)
+         batchSize = max(1, min(batchSize, -(-positions//processes)))
+      self.batches = self.buildBatches(batchSize)
+      self.tolerance = tolerance
+      self.delta = delta
+      self.sparse = sparse
+      self.kernels = chooseKernels(backend, sparse)
+      self.save = save
+      self.saveEvery = saveEvery
+      self.completed = 0   #iterations run, including those of a resumed model
+      self.trace = []
+      self.best = None   #the shared best log-likelihood of each iteration of a random restart
+      self.margin = 0.0
+      self.warmup = 0
+      self.abandoned = False   #set when fallenBehind stopped the iterations
 
 
    def iterator(self) :
       '''
-      Iterates through calculating the forward and backword probabilities then
-      Then using those to calculate Max Expectation an updating the matrices
+      Iterates through calculating the scaled forward and backword tables of
+      each batch, adding up their expected counts and then using those to
+      calculate Max Expectation and updating the matrices
+      Note:
+         with more than one process the batches are split into shards that
+         run in a ShardPool and the parent adds up the counts of each shard.
+         Each iteration appends the log-likelihood of the matrices it started
+         from, its wall time and the largest change in the matrices to
+         self.trace, and stops early once tolerance or delta is met
       '''
-      for i in range(self.iteration):
-         fwd, full_p = self.forward()
-         bwd = self.backward()
-         self.maxE(fwd, bwd, full_p)
+      pool = None
+      if self.processes > 1 and len(self.batches) > 1:
+         pool = ShardPool(self, self.processes)
+      try:
+         for i in range(self.completed, self.iteration):
+            start = time.perf_counter()
+            if pool is None:
+               t, e, logLikelihood = self.countBatches(self.batches)
+            else:
+               t, e, logLikelihood = pool.counts()
+            transition, emission = self.transition, self.emission
+            self.maxE(t, e)
+            change = max(np.abs(self.transition - transition).max(), np.abs(self.emission - emission).max())
+            self.trace.append({'iteration': i + 1, 'logLikelihood': logLikelihood,
+               'seconds': time.perf_counter() - start, 'delta': float(change)})
+            self.completed = i + 1
+            if self.save != '' and self.saveEvery and self.completed % self.saveEvery == 0:
+               self.saveModel(self.save.format(self.completed))
+            if self.converged():
+               break
+            if self.fallenBehind():
+               self.abandoned = True
+               break
+      finally:
+         if pool is not None:
+            pool.close()
+
+
+   def converged(self) :
+      '''
+      Checks the last iterations of the trace against tolerance and delta
+      '''
+      if self.delta is not None and self.trace[-1]['delta'] <= self.delta:
+         return True
+      if self.tolerance is not None and len(self.trace) > 1:
+         last = self.trace[-1]['logLikelihood']
+         previous = self.trace[-2]['logLikelihood']
+         return abs(last - previous) <= self.tolerance*abs(previous)
+      return False
+
+
+   def online(self, observations, size=100, alpha=0.6) :
+      '''
+      Trains with stepwise (online) EM over a stream of observations
+      Note:
+         the observations are read size at a time and only that mini-batch
+         is held in memory. Its expected counts per position are blended
+         into running statistics with the step (t+2)^-alpha, t the updates
+         so far, and the matrices are the normalized statistics, so each
+         mini-batch moves the model once and new data keeps adapting it. The
+         model is written every saveEvery updates when save is given, with
+         {0} in the name replaced by the update number
+      Args:
+         observations: an iterable of strings or Observations
+         size: the observations in each mini-batch
+         alpha: the decay of the step size, in (0.5, 1]
+      '''
+      k = len(self.states)
+      t = self.transition/k   #the statistics of one position under an equal prior
+      e = self.emission/k
+      for block in self.miniBatches(observations, size):
+         start = time.perf_counter()
+         counts = self.countBatches(self.buildBatches(self.batchSize, block))
+         positions = sum(len(i) for i in block)
+         step = (self.completed + 2)**-alpha
+         t = (1 - step)*t + step*counts[0]/positions
+         e = (1 - step)*e + step*counts[1]/positions
+
+         transition, emission = self.transition, self.emission
+         self.maxE(t, e)
+         change = max(np.abs(self.transition - transition).max(), np.abs(self.emission - emission).max())
+         self.trace.append({'iteration': self.completed + 1, 'logLikelihood': counts[2], 'sequences': len(block),
+            'seconds': time.perf_counter() - start, 'delta': float(change)})
+         self.completed += 1
+         if self.save != '' and self.saveEvery and self.completed % self.saveEvery == 0:
+            self.saveModel(self.save.format(self.completed))
+
+
+   def miniBatches(self, observations, size) :
+      '''
+      Yields lists of the codes of size non-empty observations at a time
+      '''
+      block = []
+      for observation in observations:
+         codes = self.convertObservation(observation)
+         if len(codes):
+            block.append(codes)
+         if len(block) == size:
+            yield block
+            block = []
+      if block:
+         yield block
+
+
+   def fallenBehind(self) :
+      '''
+      Records the log-likelihood of the last iteration in the best shared
+      between random restarts and checks whether, past the warmup
+      iterations, it is more than margin (relative) behind that best
+      '''
+      if self.best is None:
+         return False
+      i = self.trace[-1]['iteration'] - 1
+      logLikelihood = self.trace[-1]['logLikelihood']
+      with self.best.get_lock():
+         best = max(self.best[i], logLikelihood)
+         self.best[i] = best
+      return i + 1 >= self.warmup and logLikelihood < best - self.margin*abs(best)
+
+
+   def randomRestarts(self, restarts, seed=None, margin=0.01, warmup=10) :
+      '''
+      Runs Baum-Welch from restarts initializations and keeps the one with
+      the best final log-likelihood
+      Note:
+         restart 0 starts from the given matrices and the others from random
+         rows with the same zero pattern, so forbidden transitions and
+         emissions stay forbidden. The restarts run at once in a pool of
+         processes and share the best log-likelihood seen at each iteration,
+         a restart more than margin behind it after warmup iterations is
+         abandoned
+      Args:
+         restarts: the number of initializations
+         seed: the seed of the random initializations
+         margin: the relative log-likelihood a restart may fall behind
+         warmup: the iterations every restart runs before it can be abandoned
+      Returns:
+         a summary of each restart, and the matrices and trace of the best
+      '''
+      seed = np.random.SeedSequence(seed).entropy
+      best = multiprocessing.Array('d', [-np.inf]*max(self.iteration, 1))
+      tasks = [(i, seed, margin, warmup) for i in range(restarts)]
+      if self.processes > 1 and restarts > 1:
+         with multiprocessing.Pool(min(self.processes, restarts), initializer=initRestarts, initargs=(self, best)) as pool:
+            results = pool.map(restartRun, tasks, chunksize=1)
+      else:
+         initRestarts(self, best)
+         results = [restartRun(task) for task in tasks]
+
+      finished = [result for result in results if not result[0]['aborted']] or results
+      summary, self.transition, self.emission, self.trace = max(finished, key=lambda result: result[0]['logLikelihood'])
+      self.completed = summary['iterations']
+      return [result[0] for result in results]
+
+
+   def randomMatrices(self, rng) :
+      '''
+      Returns random transition and emission matrices with the zero pattern
+      of the current ones
+      '''
+      matrices = []
+      for matrix in (self.transition, self.emission):
+         m = rng.gamma(1.0, size=matrix.shape)*(matrix > 0)
+         matrices.append(self.normalize(m, matrix))
+      return matrices
+
+
+   def countBatches(self, batches) :
+      '''
+      Runs forward and backward over each batch and adds up their expected
+      transition and emission counts and their log-likelihood
+      '''
+      t = np.zeros(self.transition.shape)
+      e = np.zeros(self.emission.shape)
+      logLikelihood = 0.0
+      if self.sparse:
+         self.sparseTransition = SparseTransition(self.transition)
+      for batch, lengths in batches:
+         fwd, scale = self.forward(batch, lengths)
+         bwd = self.backward(batch, lengths, scale)
+         counts = self.expectedCounts(batch, lengths, fwd, bwd, scale)
+         t += counts[0]
+         e += counts[1]
+         logLikelihood += float(np.log(scale).sum(dtype=np.float64))
+      return t, e, logLikelihood
 
 
 
    def buildMatrix(self, matrixList) :
       '''
-      creates in the numpy array of the matrix
+      creates in the numpy array of the matrix, an array (such as the memory
+      mapped matrices of a ModelFile) is used as it is when it has the dtype
       '''
+      if isinstance(matrixList, np.ndarray):
+         return np.asarray(matrixList, self.dtype)
       m = []
       #iterate through, skipping the list and first item in each following list
       for i in range(1,len(matrixList)):
@@ -110,88 +554,188 @@ class HMM:
       #append new lines for each row of the matrix
       m = np.array(m)
       #set alll the values to float
-      matrix = m.astype(np.float)
+      matrix = m.astype(self.dtype)
       return matrix
 
 
-   def convertObservation (self) :
+   def convertObservation (self, observation) :
       '''
-      iterate through observation storing alphabet index in list
-      Returns the numeric equivalent of the observation
+      Returns the numeric equivalent of the observation, reusing the codes of
+      an Observation
       '''
-      num = []
-      for i in self.observation:
-         num.append(self.alphabet.index(i))
-      return num
+      if isinstance(observation, Observation):
+         return observation.codes
+      return self.encoder.encode(observation)
 
 
-   def forward(self):
-      '''calculates the probability of the sequence'''
-      observed = self.convertObservation()   #convert observed into numberic representation
-      prior = 1/len(self.states)   #starting probability of that state
-      
-      #create empty array to hold calculations for each poisition in the observation
-      fwd=np.zeros((len(self.observation),len(self.states)))   
-      
+   def buildBatches (self, batchSize, observations=None) :
+      '''
+      Groups the observations into padded 2-D arrays, longest first
+      Note:
+         sequences are sorted by length and a new batch starts once the batch
+         would hold more than batchSize positions or the next sequence is less
+         than half as long as the first, which keeps the padding small. Rows
+         of a batch are in decreasing length so the sequences still running at
+         any position are always the leading rows
+      Returns:
+         a list of (batch, lengths) with batch a sequences x length int array,
+         of observationIndex unless a list of codes is given
+      '''
+      if observations is None:
+         observations = self.observationIndex
+      ordered = sorted(observations, key=len, reverse=True)
+      batches = []
+      start = 0
+      while start < len(ordered):
+         longest = len(ordered[start])
+         stop = start + 1
+         while (stop < len(ordered) and (stop - start + 1)*longest <= batchSize
+                and 2*len(ordered[stop]) >= longest):
+            stop += 1
+         lengths = np.array([len(i) for i in ordered[start:stop]])
+         batch = np.zeros((stop - start, longest), dtype=int)
+         for row, i in enumerate(ordered[start:stop]):
+            batch[row, :len(i)] = i
+         batches.append((batch, lengths))
+         start = stop
+      return batches
+
+
+   def forward(self, batch, lengths):
+      '''
+      Calculates the scaled forward tables of a batch of sequences
+      Note:
+         each row is normalized to sum to 1 and the normalizing constant is
+         kept in scale, so Pr(x) is the product of scale (log Pr(x) the sum of
+         its logs) and long observations no longer underflow to zero. Padding
+         past the end of a sequence keeps a scale of 1
+      Returns:
+         fwd: a sequences x length x k array of the scaled forward probabilities
+         scale: a sequences x length array of the scaling constants
+      '''
+      emission = np.ascontiguousarray(self.emission.T) #one row of emission probabilities per symbol
+      prior = self.initial   #starting probability of each state
+      running = (lengths[np.newaxis, :] > np.arange(batch.shape[1])[:, np.newaxis]).sum(1) #sequences still running at each position
+
+      #create empty arrays to hold calculations for each poisition in the observation
+      fwd = np.zeros(batch.shape + (len(self.states),), self.dtype)
+      scale = np.ones(batch.shape, self.dtype)
+
       #initializes with the starting probability prior
-      fwd[0]=prior*self.emission[:,observed[0]]   
-     
+      row = prior*emission[batch[:, 0]]
+      scale[:, 0] = row.sum(1)
+      fwd[:, 0] = row/scale[:, 0, np.newaxis]
+
       #Iterate through multiplying the probability for each position
-      for t in range(len(self.observation)-1):   
-         fwd[t+1]=np.dot(fwd[t],self.transition)*self.emission[:,observed[t+1]]
-      #returns the sum
-      return fwd, fwd[-1].sum()
+      self.kernels.forward(self, emission, batch, lengths, running, fwd, scale)
+
+      if not (scale > 0).all():
+         sequence, position = np.argwhere(scale <= 0)[0]
+         raise ValueError('observation has zero probability at position {0}'.format(position+1))
+      return fwd, scale
 
 
-   def backward(self):
+   def backward(self, batch, lengths, scale):
       '''
-      Calculates the backwords probability from a given observation using the
-      emission and transition matrices
+      Calculates the backwords tables of a batch from the emission and
+      transition matrices, scaled by the constants of forward so that
+      fwd * bwd is the posterior probability of each state
       '''
-      obsArray = np.array(self.observationIndex) #converts the observation into an Array
-      matrix = np.zeros((self.len, len(self.states))) #creates an empty matrix
-      for i in range(len(self.states)): #iterates through states storing positions in matrix
-         matrix[self.len - 1, i] = 1
-      for i in reversed(range(self.len - 1)): #iterates through the observation in reverse
-         matrix[i] = np.dot(matrix[i + 1] * self.emission[:, obsArray[i + 1]], self.transition.T)
+      emission = np.ascontiguousarray(self.emission.T) #one row of emission probabilities per symbol
+      running = (lengths[np.newaxis, :] > np.arange(batch.shape[1])[:, np.newaxis]).sum(1)
+      matrix = np.zeros(batch.shape + (len(self.states),), self.dtype) #creates an empty matrix
+      matrix[np.arange(len(lengths)), lengths - 1] = 1
+      self.kernels.backward(self, emission, batch, lengths, running, scale, matrix)
       return matrix
 
 
-   def maxE(self, fwd, bwd, obsProb):
+   def transitionDot(self, x) :
       '''
-      Calculates the max expectation for both the transition and emission
-      matrices
+      Returns x times the transition matrix, through only its nonzero entries
+      in sparse mode
       '''
-      alphaIndex = {y: x for x, y in enumerate(self.alphabet)}
-      x = np.array([alphaIndex[i] for i in self.observation])
+      if self.sparse:
+         return self.sparseTransition.dot(x)
+      return np.dot(x, self.transition)
 
-      dimesion = (fwd * bwd) / obsProb
-      k =len(self.states)
-      l = len(self.alphabet) 
-      
-      t = np.zeros((k, k)) #build empty matrix of correct dimensions
-      e = np.zeros((k, l)) #build empty matrix of correct dimensions
 
-      for i in range(k): #optimizes the transition matrices 't'
-         for j in range(self.len-1):
-            t[i, :] += (fwd[j][i] * self.transition[i,:] * self.emission[:,alphaIndex[self.observation[j+1]]]* bwd[j + 1])/obsProb
-         t[i, :] = t[i, :] / sum(t[i, :])
+   def transitionDotT(self, x) :
+      '''
+      Returns x times the transposed transition matrix, through only its
+      nonzero entries in sparse mode
+      '''
+      if self.sparse:
+         return self.sparseTransition.dotT(x)
+      return np.dot(x, self.transition.T)
+
 
-      for i in range(k): #optimizes the emission matrices 'e'
-         for j in range(l):
-            e[i,j] = (np.sum(dimesion[x==j,i]))/(np.sum(dimesion[:,i]))
+   def expectedCounts(self, batch, lengths, fwd, bwd, scale):
+      '''
+      Calculates the expected transition and emission counts of a batch
+      Note:
+         the counts are built from whole-array operations over the scaled
+         tables, the only loops are over the states. Padded positions are
+         masked out so no transitions are counted between sequences
+      Returns:
+         the k x k expected transition counts and k x l expected emission counts
+      '''
+      k = len(self.states)
+      l = len(self.alphabet)
+      valid = np.arange(batch.shape[1])[np.newaxis, :] < lengths[:, np.newaxis]
+
+      dimesion = (fwd * bwd)[valid] #probability of each state at each position
+
+      #expected transitions i->j summed over every position at once
+      right = self.emission.T[batch[:, 1:]] * bwd[:, 1:] / scale[:, 1:, np.newaxis]
+      right *= valid[:, 1:, np.newaxis]
+      if self.sparse:
+         t = self.sparseTransition.counts(fwd[:, :-1].reshape(-1, k), right.reshape(-1, k))
+      else:
+         t = self.transition * np.tensordot(fwd[:, :-1], right, axes=([0, 1], [0, 1]))
 
-      self.transition = t
-      self.emission = e
+      #expected emissions of each symbol from each state
+      x = batch[valid]
+      e = np.zeros((k, l))
+      for i in range(k):
+         e[i] = np.bincount(x, weights=dimesion[:, i], minlength=l)
 
       return t, e
+
+
+   def normalize(self, counts, previous) :
+      '''
+      Divides each row of counts by its sum, keeping the previous row for any
+      state that collected no expected counts instead of producing NaN
+      '''
+      total = counts.sum(axis=1, keepdims=True)
+      return np.where(total > 0, counts/np.where(total > 0, total, 1), previous).astype(self.dtype)
+
+
+   def maxE(self, t, e):
+      '''
+      Calculates the max expectation for both the transition and emission
+      matrices from the expected counts summed over all the sequences
+      '''
+      self.transition = self.normalize(t, self.transition)
+      self.emission = self.normalize(e, self.emission)
+
+      return self.transition, self.emission
    
 
+   def saveModel (self, fname) :
+      '''
+      Writes the matrices, the prior and the iterations run to a ModelFile
+      '''
+      metadata = {'program': 'baum-WelchLearning', 'iterations': self.completed}
+      if self.trace:
+         metadata['logLikelihood'] = self.trace[-1]['logLikelihood']
+      ModelFile(fname).write(self.states, self.alphabet, self.transition, self.emission, self.initial, metadata)
+
+
    def printMatrices (self) :
       '''
       Prints the emission and transmission matrices
       '''
-      self.iterator()
       e = self.emission.astype(str)
       t = self.transition.astype(str)
       print(" " +" ".join(self.states)) #prints transition matrix
@@ -203,16 +747,396 @@ class HMM:
          print(self.states[i]+" "+" ".join(e[i]))
 
 
-def main() :
+class SparseTransition :
+   '''
+   Note:
+      Holds only the nonzero entries of a k x k transition matrix, in
+      compressed row (CSR) order and again in column order, so a product with
+      it costs the number of nonzero transitions instead of k*k. Banded and
+      profile models with thousands of mostly forbidden transitions gain the
+      most
+   Args:
+      matrix: the dense transition matrix
+   '''
+
+   def __init__(self, matrix) :
+      '''
+      Stores the nonzero entries and where each row and column starts
+      '''
+      self.k = len(matrix)
+      self.rows, self.cols = np.nonzero(matrix) #row major, so already in CSR order
+      self.values = matrix[self.rows, self.cols]
+      self.rowStarts = np.flatnonzero(np.diff(self.rows, prepend=-1))
+      self.rowIds = self.rows[self.rowStarts]
+
+      #the same entries ordered by column, rows still increasing within a column
+      order = np.argsort(self.cols, kind='stable')
+      self.colRows = self.rows[order]
+      self.colValues = self.values[order]
+      self.colStarts = np.flatnonzero(np.diff(self.cols[order], prepend=-1))
+      self.colIds = self.cols[order][self.colStarts]
+
+
+   def dot(self, x) :
+      '''
+      Returns x times the matrix for x with the states on its last axis
+      '''
+      out = np.zeros(x.shape[:-1] + (self.k,), np.result_type(x, self.values))
+      if len(self.values):
+         out[..., self.colIds] = np.add.reduceat(x[..., self.colRows]*self.colValues, self.colStarts, axis=-1)
+      return out
+
+
+   def dotT(self, x) :
+      '''
+      Returns x times the transposed matrix for x with the states on its last axis
+      '''
+      out = np.zeros(x.shape[:-1] + (self.k,), np.result_type(x, self.values))
+      if len(self.values):
+         out[..., self.rowIds] = np.add.reduceat(x[..., self.cols]*self.values, self.rowStarts, axis=-1)
+      return out
+
+
+   def counts(self, left, right, block=1<<22) :
+      '''
+      Returns the k x k matrix of each nonzero entry times the sum over
+      positions of left[state from] * right[state to], the expected
+      transition counts of Baum-Welch, in blocks of positions that keep the
+      gathered arrays near block entries
+      '''
+      total = np.zeros(len(self.values))
+      step = max(1, block//max(len(self.values), 1))
+      for start in range(0, len(left), step):
+         total += np.einsum('ij,ij->j', left[start:start + step][:, self.rows], right[start:start + step][:, self.cols])
+      matrix = np.zeros((self.k, self.k))
+      matrix[self.rows, self.cols] = self.values*total
+      return matrix
+
+
+class NumpyKernels :
+   '''
+   Note:
+      The reference recursions over a padded batch, one NumPy call per
+      position for all the sequences still running there. They work with
+      every transition product of an HMM, dense or sparse
+   '''
+
+   name = 'numpy'
+
+   def forward(self, hmm, emission, batch, lengths, running, fwd, scale) :
+      '''
+      Fills the scaled forward rows and scaling constants of a batch after
+      its first position
+      '''
+      for t in range(1, batch.shape[1]):
+         m = running[t]
+         row = hmm.transitionDot(fwd[:m, t-1])*emission[batch[:m, t]]
+         scale[:m, t] = row.sum(1)
+         fwd[:m, t] = row/scale[:m, t, np.newaxis]
+
+
+   def backward(self, hmm, emission, batch, lengths, running, scale, matrix) :
+      '''
+      Fills the backward rows of a batch before the last of each sequence,
+      scaled by the forward constants
+      '''
+      for i in reversed(range(batch.shape[1] - 1)): #iterates through the observation in reverse
+         m = running[i + 1]
+         matrix[:m, i] = hmm.transitionDotT(emission[batch[:m, i + 1]]*matrix[:m, i + 1])/scale[:m, i + 1, np.newaxis]
+
+
+class LoopKernels :
+   '''
+   Note:
+      The recursions as plain loops over the sequences, positions and
+      states, compiled once with Numba. A position costs no Python call, so
+      a single long observation, a batch of one row that the NumPy kernels
+      step through one call per position, runs at compiled speed. Only
+      dense transition matrices are run this way
+   Args:
+      compile: the compiler of the loop functions, numba.njit by default
+   '''
+
+   name = 'numba'
+
+   def __init__(self, compile=None) :
+      '''
+      Compiles the loop functions
+      '''
+      compile = compile or numba.njit(cache=True)
+      self.forwardLoop = compile(forwardLoop)
+      self.backwardLoop = compile(backwardLoop)
+
+
+   def forward(self, hmm, emission, batch, lengths, running, fwd, scale) :
+      '''the forward rows, as NumpyKernels.forward'''
+      self.forwardLoop(np.ascontiguousarray(hmm.transition), emission, batch, lengths, fwd, scale)
+
+
+   def backward(self, hmm, emission, batch, lengths, running, scale, matrix) :
+      '''the backward rows, as NumpyKernels.backward'''
+      self.backwardLoop(np.ascontiguousarray(hmm.transition), emission, batch, lengths, scale, matrix)
+
+
+def forwardLoop(transition, emission, batch, lengths, fwd, scale) :
+   '''
+   The scaled forward recursion of NumpyKernels.forward as loops, one
+   sequence of the batch at a time
+   '''
+   k = transition.shape[0]
+   for r in range(batch.shape[0]):
+      for t in range(1, lengths[r]):
+         total = 0.0
+         for j in range(k):
+            acc = 0.0
+            for i in range(k):
+               acc += fwd[r, t - 1, i]*transition[i, j]
+            fwd[r, t, j] = acc*emission[batch[r, t], j]
+            total += fwd[r, t, j]
+         scale[r, t] = total
+         if total <= 0:
+            break #forward reports the zero probability position
+         for j in range(k):
+            fwd[r, t, j] /= total
+
+
+def backwardLoop(transition, emission, batch, lengths, scale, matrix) :
+   '''
+   The backward recursion of NumpyKernels.backward as loops, one sequence
+   of the batch at a time
+   '''
+   k = transition.shape[0]
+   weighted = np.empty(k, matrix.dtype)
+   for r in range(batch.shape[0]):
+      for t in range(lengths[r] - 2, -1, -1):
+         for j in range(k):
+            weighted[j] = emission[batch[r, t + 1], j]*matrix[r, t + 1, j]
+         for i in range(k):
+            acc = 0.0
+            for j in range(k):
+               acc += transition[i, j]*weighted[j]
+            matrix[r, t, i] = acc/scale[r, t + 1]
+
+
+def chooseKernels(backend='auto', sparse=False) :
+   '''
+   Returns the kernels of a backend: numpy, numba, or auto for numba when it
+   is installed. numba falls back to numpy, with a warning, without it or
+   for a sparse model, whose products only the numpy kernels run
+   '''
+   if sparse:
+      if backend == 'numba':
+         print('sparse models run on the numpy backend, ignoring --backend numba', file=sys.stderr)
+      return NumpyKernels()
+   if backend == 'numpy' or (backend == 'auto' and numba is None):
+      return NumpyKernels()
+   if numba is None:
+      print('numba is not installed, using the numpy backend', file=sys.stderr)
+      return NumpyKernels()
+   return LoopKernels()
+
+
+class ShardPool :
+   '''
+   Note:
+      Runs the E-step of an HMM over shards of its batches in worker
+      processes. The batches are copied into shared memory once and the model
+      matrices are written into shared memory once per iteration, so a task
+      only carries where its batches are and returns the summed counts
+   Args:
+      hmm: the HMM being trained
+      processes: the number of worker processes
+   Returns:
+      The expected transition and emission counts added up over the shards
+   '''
+
+   def __init__(self, hmm, processes) :
+      '''
+      Copies the batches into shared memory, splits them into balanced shards
+      and starts the workers
+      '''
+      k = len(hmm.states)
+      l = len(hmm.alphabet)
+      size = sum(batch.size for batch, lengths in hmm.batches)
+      self.hmm = hmm
+      self.data = shared_memory.SharedMemory(create=True, size=size*8)
+      self.model = shared_memory.SharedMemory(create=True, size=(k*k + k*l)*8)
+      self.matrices = np.ndarray(k*k + k*l, np.float64, self.model.buf)
+
+      #largest batch first to the least loaded shard
+      codes = np.ndarray(size, np.int64, self.data.buf)
+      shards = [[] for i in range(min(processes, len(hmm.batches)))]
+      load = [0]*len(shards)
+      offset = 0
+      for batch, lengths in sorted(hmm.batches, key=lambda b: b[0].size, reverse=True):
+         codes[offset:offset + batch.size] = batch.ravel()
+         i = load.index(min(load))
+         shards[i].append((offset, batch.shape, lengths))
+         load[i] += batch.size
+         offset += batch.size
+      del codes
+      self.shards = shards
+
+      self.pool = multiprocessing.Pool(len(shards), initializer=initWorker,
+         initargs=(hmm.states, hmm.alphabet, hmm.initial, hmm.sparse, hmm.dtype, hmm.kernels.name, self.data.name, size, self.model.name))
+
+
+   def counts(self) :
+      '''
+      Publishes the current matrices and adds up the counts and
+      log-likelihood of every shard
+      '''
+      k = len(self.hmm.states)
+      self.matrices[:k*k] = self.hmm.transition.ravel()
+      self.matrices[k*k:] = self.hmm.emission.ravel()
+      t = np.zeros(self.hmm.transition.shape)
+      e = np.zeros(self.hmm.emission.shape)
+      logLikelihood = 0.0
+      for counts in self.pool.map(shardCounts, self.shards):
+         t += counts[0]
+         e += counts[1]
+         logLikelihood += counts[2]
+      return t, e, logLikelihood
+
+
+   def close(self) :
+      '''
+      Stops the workers and frees the shared memory
+      '''
+      self.pool.close()
+      self.pool.join()
+      del self.matrices
+      for block in (self.data, self.model):
+         block.close()
+         block.unlink()
+
+
+workerState = {}
+
+
+def initWorker(states, alphabet, initial, sparse, dtype, backend, dataName, size, modelName) :
+   '''
+   Attaches a worker process to the shared batches and matrices of a ShardPool
+   '''
+   k = len(states)
+   l = len(alphabet)
+   data = shared_memory.SharedMemory(name=dataName)
+   model = shared_memory.SharedMemory(name=modelName)
+   matrices = np.ndarray(k*k + k*l, np.float64, model.buf)
+
+   #an HMM without observations, its matrices are taken from the shared memory by each shard
+   hmm = HMM.__new__(HMM)
+   hmm.states = states
+   hmm.alphabet = alphabet
+   hmm.initial = initial
+   hmm.sparse = sparse
+   hmm.dtype = dtype
+   hmm.kernels = chooseKernels(backend, sparse)
+
+   workerState['matrices'] = (matrices[:k*k].reshape(k, k), matrices[k*k:].reshape(k, l))
+   workerState['blocks'] = (data, model)
+   workerState['codes'] = np.ndarray(size, np.int64, data.buf)
+   workerState['hmm'] = hmm
+
+
+def shardCounts(shard) :
+   '''
+   Returns the expected counts of one shard, run inside a worker process
+   '''
+   codes = workerState['codes']
+   batches = []
+   for offset, shape, lengths in shard:
+      batches.append((codes[offset:offset + shape[0]*shape[1]].reshape(shape), lengths))
+   hmm = workerState['hmm']
+   hmm.transition, hmm.emission = (m.astype(hmm.dtype, copy=False) for m in workerState['matrices'])
+   return hmm.countBatches(batches)
+
+
+restartState = {}
+
+
+def initRestarts(hmm, best) :
+   '''
+   Keeps the HMM the restarts copy and the shared best log-likelihoods
+   '''
+   restartState['hmm'] = hmm
+   restartState['best'] = best
+
+
+def restartRun(task) :
+   '''
+   Runs one random restart, in a worker process or the parent, and returns
+   its summary, matrices and trace
+   '''
+   index, seed, margin, warmup = task
+   start = time.perf_counter()
+   hmm = copy.copy(restartState['hmm']) #shares the batches
+   hmm.processes = 1
+   hmm.save = ''
+   hmm.completed = 0
+   hmm.trace = []
+   hmm.abandoned = False
+   hmm.best, hmm.margin, hmm.warmup = restartState['best'], margin, warmup
+   if index:
+      hmm.transition, hmm.emission = hmm.randomMatrices(np.random.default_rng([seed, index]))
+   hmm.iterator()
+
+   aborted = hmm.abandoned #a restart that converged is finished, even behind the best
+   if aborted:
+      logLikelihood = hmm.trace[-1]['logLikelihood']
+   else:
+      logLikelihood = hmm.countBatches(hmm.batches)[2] #of the final matrices
+   summary = {'restart': index, 'iterations': hmm.completed, 'logLikelihood': logLikelihood,
+      'aborted': bool(aborted), 'seconds': time.perf_counter() - start}
+   return summary, hmm.transition, hmm.emission, hmm.trace
+
+
+def main(myCommandLine=None) :
+
+   if myCommandLine is None:
+      myCommandLine = CommandLine()
 
    # read file and store as matrices
    fileReader = FileReader('')
    matrices = fileReader.readFile()
 
    # initialize hmm object and print the probability
-   hmm = HMM(int(matrices[0][0][0]), matrices[1][0][0], matrices[2][0], matrices[3][0], matrices[4], matrices[5])
+   # each line of the observation section is trained as its own sequence
+   # a resumed model takes the place of the alphabet, states and matrix sections
+   model = ModelFile(myCommandLine.args['resume'])
+   if myCommandLine.args['resume'] != '':
+      model.read()
+      alphabet, states, transition, emission = model.alphabet, model.states, model.transition, model.emission
+   else:
+      alphabet, states, transition, emission = matrices[2][0], matrices[3][0], matrices[4], matrices[5]
+   observations = [line[0] for line in matrices[1] if line]
+   if myCommandLine.args['observation'] != '':
+      observations = Observation(alphabet, fname=myCommandLine.args['observation'])
+   hmm = HMM(int(matrices[0][0][0]), observations, alphabet, states, transition, emission,
+      batchSize=myCommandLine.args['batch_size'], processes=myCommandLine.args['processes'], tolerance=myCommandLine.args['tolerance'],
+      delta=myCommandLine.args['delta'], sparse=myCommandLine.args['sparse'], initial=model.initial,
+      save=myCommandLine.args['save'], saveEvery=myCommandLine.args['save_every'],
+      dtype=np.float32 if myCommandLine.args['precision'] == 32 else np.float64,
+      backend=myCommandLine.args['backend'])
+   hmm.completed = model.metadata.get('iterations', 0)
 
+   if myCommandLine.args['online'] != '':
+      with open(myCommandLine.args['online']) as fileH:
+         hmm.online((line.strip() for line in fileH), myCommandLine.args['minibatch'], myCommandLine.args['alpha'])
+   elif myCommandLine.args['restarts'] > 1:
+      summary = hmm.randomRestarts(myCommandLine.args['restarts'], myCommandLine.args['seed'], myCommandLine.args['abort'])
+      for run in summary:
+         print('restart {restart}\titerations {iterations}\tlogLikelihood {logLikelihood!r}\t{0}'.format(
+            'abandoned' if run['aborted'] else 'finished', **run), file=sys.stderr)
+   else:
+      hmm.iterator()
    hmm.printMatrices()
+   if myCommandLine.args['save'] != '':
+      hmm.saveModel(myCommandLine.args['save'].format(hmm.completed))
+
+   if myCommandLine.args['trace'] is not None:
+      with open(myCommandLine.args['trace'], 'w') as traceH:
+         json.dump(hmm.trace, traceH, indent=1)
 
 
 if __name__ == "__main__":
@@ -0,0 +1,222 @@
+#!/usr/bin/env python3
+# Max Genetti (mgenetti)
+
+'''
+This program checks that the recursion backends of softDecoding.py,
+viterbiLearning.py and baum-WelchLearning.py agree.
+
+Random models and observations are made with hmmGenerator.py and run through
+NumpyKernels, the reference, and through LoopKernels. The loop functions are
+run as plain Python (compile=lambda f: f), so the check runs without Numba,
+and also compiled by Numba when it is installed. Compared are the soft
+decoding forward and backward tables, scaling constants and posteriors, the
+checkpointed posteriors of softDecoding windows, the viterbi paths with and
+without checkpoints, and the Baum-Welch expected counts and log-likelihood of
+the observation alone (a one row batch) and of pieces of it of different
+lengths (padded batches), in float64 and float32.
+
+Prints one line per check and exits with an AssertionError if any differ.
+'''
+
+import os
+import sys
+import importlib.util
+import numpy as np
+
+
+def loadScript(name, fname) :
+   '''
+   Returns a script of this directory imported as a module, the scripts are
+   loaded by path since their names are not valid module names
+   '''
+   path = os.path.join(os.path.dirname(os.path.abspath(__file__)), fname)
+   spec = importlib.util.spec_from_file_location(name, path)
+   module = importlib.util.module_from_spec(spec)
+   spec.loader.exec_module(module)
+   return module
+
+
+softDecoding = loadScript('softDecoding', 'softDecoding .py')
+viterbiLearning = loadScript('viterbiLearning', 'viterbiLearning.py')
+baumWelch = loadScript('baumWelch', 'baum-WelchLearning.py')
+hmmGenerator = loadScript('hmmGenerator', 'hmmGenerator.py')
+
+
+class CommandLine() :
+   '''
+   Handle the command line, usage and help requests.
+
+   CommandLine uses argparse to parse the options given on the command line.
+
+   attributes:
+   myCommandLine.args is a dictionary which includes each of the available
+   command line arguments as myCommandLine.args['option']
+   '''
+
+   def __init__(self, inOpts=None) :
+      '''
+      CommandLine constructor.
+      Implements a parser to interpret the command line argv string using argparse.
+      '''
+      import argparse
+      self.parser = argparse.ArgumentParser(
+         description = 'Check that the numpy and loop backends of the HMM scripts agree',
+         add_help = True, #default is True
+         prefix_chars = '-',
+         usage = '%(prog)s [options]'
+         )
+      self.parser.add_argument('-k', '--states', type=int, default=4, action = 'store',
+         help='states of each random model (default 4)')
+      self.parser.add_argument('-l', '--symbols', type=int, default=3, action = 'store',
+         help='alphabet size of each random model (default 3)')
+      self.parser.add_argument('-n', '--length', type=int, default=2000, action = 'store',
+         help='symbols in each observation (default 2000)')
+      self.parser.add_argument('-c', '--count', type=int, default=3, action = 'store',
+         help='random models checked (default 3)')
+      self.parser.add_argument('--seed', type=int, default=0, action = 'store',
+         help='seed of the models and observations (default 0)')
+      if inOpts is None :
+         self.args = vars(self.parser.parse_args())
+      else :
+         self.args = vars(self.parser.parse_args(inOpts))
+
+
+class BackendCheck :
+   '''
+   Note:
+      Runs one model and observation through the reference kernels and the
+      loop kernels of each script and compares the results, closeness being
+      np.allclose with a tolerance for the float type
+   Args:
+      alphabet: a list of the single character symbols
+      states: a list of the state names
+      transition: the k x k transition matrix
+      emission: the k x l emission matrix
+      observation: a string of symbols of the alphabet
+      dtype: the float type the HMMs run in
+   '''
+
+   def __init__(self, alphabet, states, transition, emission, observation, dtype=np.float64) :
+      '''
+      Stores the model and observation
+      '''
+      self.model = (alphabet, states, transition, emission)
+      self.observation = observation
+      self.dtype = np.dtype(dtype)
+      self.rtol = 1e-9 if self.dtype == np.float64 else 1e-4
+      self.failures = []
+
+
+   def soft(self, kernels) :
+      '''
+      Returns the forward table, scaling constants, backward table,
+      posteriors and checkpointed window posteriors of softDecoding
+      '''
+      hmm = softDecoding.HMM(self.observation, *self.model, dtype=self.dtype)
+      hmm.kernels = kernels
+      fwd, scale = hmm.forward()
+      bwd = hmm.backward()
+      posteriors = np.concatenate(list(hmm.posteriors(chunkSize=257)))
+      n = hmm.len
+      windows = hmm.windows([(0, min(n, 50)), (n//3, n//3 + 1), (n//2, n)], every=37)
+      return [fwd, scale, bwd, posteriors] + windows
+
+
+   def paths(self, kernels) :
+      '''
+      Returns the viterbi paths of viterbiLearning without checkpoints and
+      with checkpoints every 37 and every square root positions
+      '''
+      paths = []
+      for checkpoint in (None, 37, 0):
+         hmm = viterbiLearning.HMM(0, self.observation, *self.model, checkpoint=checkpoint, dtype=self.dtype)
+         hmm.kernels = kernels
+         hmm.viterbi()
+         paths.append(np.array(hmm.pathIndex))
+      return paths
+
+
+   def counts(self, kernels) :
+      '''
+      Returns the Baum-Welch transition counts, emission counts and
+      log-likelihood of the observation as one sequence, and of pieces of it
+      cut at random lengths run through small padded batches
+      '''
+      n = len(self.observation)
+      cuts = np.unique(np.random.default_rng(n).integers(1, n, 12)) if n > 1 else []
+      pieces = [self.observation[a:b] for a, b in zip([0, *cuts], [*cuts, n])]
+      results = []
+      for observations, batchSize in (([self.observation], 1<<20), (pieces, 4*n//len(pieces))):
+         hmm = baumWelch.HMM(1, observations, *self.model, batchSize=batchSize, dtype=self.dtype)
+         hmm.kernels = kernels
+         t, e, logLikelihood = hmm.countBatches(hmm.batches)
+         results += [t, e, np.array([logLikelihood])]
+      return results
+
+
+   def compare(self, name, loopSoft, loopViterbi, loopBaumWelch) :
+      '''
+      Compares the loop kernels of both scripts with the reference, adding
+      the name of each check that differs to failures
+      '''
+      reference = self.soft(softDecoding.NumpyKernels())
+      found = self.soft(loopSoft)
+      labels = ['forward', 'scale', 'backward', 'posteriors'] + ['window {0}'.format(i) for i in range(len(found) - 4)]
+      for label, a, b in zip(labels, reference, found):
+         self.report('{0} softDecoding {1}'.format(name, label), np.allclose(a, b, rtol=self.rtol, atol=self.rtol*1e-3))
+
+      reference = self.paths(viterbiLearning.NumpyKernels())
+      found = self.paths(loopViterbi)
+      for label, a, b in zip(['no checkpoint', 'checkpoint 37', 'checkpoint sqrt'], reference, found):
+         self.report('{0} viterbi {1}'.format(name, label), np.array_equal(a, b))
+
+      reference = self.counts(baumWelch.NumpyKernels())
+      found = self.counts(loopBaumWelch)
+      labels = ['{0} {1}'.format(part, batches) for batches in ('one sequence', 'batches')
+         for part in ('transition counts', 'emission counts', 'log-likelihood')]
+      for label, a, b in zip(labels, reference, found):
+         self.report('{0} baum-Welch {1}'.format(name, label), np.allclose(a, b, rtol=self.rtol, atol=self.rtol*1e-3))
+
+
+   def report(self, label, ok) :
+      '''
+      Prints the result of one check and keeps the failures
+      '''
+      print('{0:<8} {1} {2}'.format('ok' if ok else 'FAILED', self.dtype.name, label))
+      if not ok:
+         self.failures.append('{0} {1}'.format(self.dtype.name, label))
+
+
+def main(myCommandLine=None) :
+
+   if myCommandLine is None:
+      myCommandLine = CommandLine()
+   args = myCommandLine.args
+   rng = np.random.default_rng(args['seed'])
+
+   # the loop functions as plain Python always, compiled when numba is installed
+   backends = [('python', softDecoding.LoopKernels(compile=lambda f: f), viterbiLearning.LoopKernels(compile=lambda f: f),
+      baumWelch.LoopKernels(compile=lambda f: f))]
+   if softDecoding.numba is not None:
+      backends.append(('numba', softDecoding.LoopKernels(), viterbiLearning.LoopKernels(), baumWelch.LoopKernels()))
+   else:
+      print('numba is not installed, checking the uncompiled loops only', file=sys.stderr)
+
+   failures = []
+   for i in range(args['count']):
+      alphabet, states, transition, emission = hmmGenerator.randomModel(args['states'], args['symbols'], 0.3*i/max(args['count'], 1), rng)
+      generator = hmmGenerator.Generator(alphabet, states, transition, emission, seed=rng.integers(1<<63))
+      path, symbols, ends = next(generator.sample([args['length']]))
+      observation = ''.join(np.asarray(alphabet)[symbols].tolist())
+      for dtype in (np.float64, np.float32):
+         check = BackendCheck(alphabet, states, transition, emission, observation, dtype)
+         for name, loopSoft, loopViterbi, loopBaumWelch in backends:
+            check.compare('model {0} {1}'.format(i + 1, name), loopSoft, loopViterbi, loopBaumWelch)
+         failures += check.failures
+
+   assert not failures, '{0} checks differ: {1}'.format(len(failures), ', '.join(failures))
+   print('all backends agree', file=sys.stderr)
+
+
+if __name__ == "__main__":
+   main()
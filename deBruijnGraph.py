@@ -10,9 +10,49 @@ reader class FileReader.
 Given: An integer k and a string Text.
 
 Return: DeBruijnk(Text), in the form of an adjacency list.
+
+With -g FILE the text is read from a 2-bit genome store written by
+proteinDecoder.py --index, k given with -k. The k-mers are taken from the runs
+of each record between its masked (N) bases.
 '''
 
+import os
 import sys
+import importlib.util
+
+
+class CommandLine() :
+   '''
+   Handle the command line, usage and help requests.
+
+   CommandLine uses argparse to parse the options given on the command line.
+
+   attributes:
+   myCommandLine.args is a dictionary which includes each of the available
+   command line arguments as myCommandLine.args['option']
+   '''
+
+   def __init__(self, inOpts=None) :
+      '''
+      CommandLine constructor.
+      Implements a parser to interpret the command line argv string using argparse.
+      '''
+      import argparse
+      self.parser = argparse.ArgumentParser(
+         description = 'Print the DeBruijn graph of the k-mers of a string',
+         add_help = True, #default is True
+         prefix_chars = '-',
+         usage = '%(prog)s [options] < input > output'
+         )
+      self.parser.add_argument('-g', '--genome', default='', action = 'store',
+         help='read the text from this genome store instead of the input')
+      self.parser.add_argument('-k', '--kmer', type=int, default=0, action = 'store',
+         help='the k-mer length of a -g genome')
+      if inOpts is None :
+         self.args = vars(self.parser.parse_args())
+      else :
+         self.args = vars(self.parser.parse_args(inOpts))
+
 
 class FileReader :
    '''
@@ -56,6 +96,8 @@ class sequenceParser :
 
    Args:
       entry: An indexable object where entry[0] is int and entry[1] is string
+         or an iterable of strings, whose k-mers are taken together, each
+         string read only when its k-mers are taken
    
    Returns:
       A DeBruijn in the form of an adjacency list of the sequences of length
@@ -70,8 +112,10 @@ class sequenceParser :
    def parse(self) :
       '''Returns parsed sequence in lexigraphic order'''
       kList = []
-      for i in range(0, len(self.sequence)  - self.kmer +1):
-         kList.append(self.sequence[i:i+self.kmer])
+      sequences = [self.sequence] if isinstance(self.sequence, str) else self.sequence
+      for sequence in sequences:
+         for i in range(0, len(sequence)  - self.kmer +1):
+            kList.append(sequence[i:i+self.kmer])
       kList.sort()
       return kList
 
@@ -87,15 +131,48 @@ class sequenceParser :
       return pairD
   
 
-def main():
-   
-   '''Reads the file given in systdin'''
-   fileReader = FileReader()
-   seqFile = fileReader.readFile()
+def loadScript(name, fname) :
+   '''
+   Returns a script of this directory imported as a module, loaded by path
+   so this runs from any directory
+   '''
+   path = os.path.join(os.path.dirname(os.path.abspath(__file__)), fname)
+   spec = importlib.util.spec_from_file_location(name, path)
+   module = importlib.util.module_from_spec(spec)
+   spec.loader.exec_module(module)
+   return module
+
 
-   '''generates a kmer and sequence in the file'''
-   for entry in seqFile:
-      x = entry
+def storeSegments(fname) :
+   '''
+   Yields the unmasked runs of every record of a genome store as strings, one
+   at a time from the memory map so only the run being parsed is held
+   '''
+   store = loadScript('proteinDecoder', 'proteinDecoder.py').GenomeFile(fname).read()
+   data = store.map()
+   for record in range(len(store.records)):
+      for start, bases in store.segments(data, record):
+         yield bases
+
+
+def main(myCommandLine=None):
+
+   if myCommandLine is None:
+      myCommandLine = CommandLine()
+
+   if myCommandLine.args['genome'] != '':
+      '''the unmasked runs of every record of a genome store'''
+      if myCommandLine.args['kmer'] < 1:
+         myCommandLine.parser.error('-g needs -k')
+      x = (myCommandLine.args['kmer'], storeSegments(myCommandLine.args['genome']))
+   else:
+      '''Reads the file given in systdin'''
+      fileReader = FileReader()
+      seqFile = fileReader.readFile()
+
+      '''generates a kmer and sequence in the file'''
+      for entry in seqFile:
+         x = entry
 
    '''Initializes the class object sequenceParser and calls pairItUp'''
    seqs = sequenceParser(x)
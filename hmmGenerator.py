@@ -0,0 +1,275 @@
+#!/usr/bin/env python3
+# Max Genetti (mgenetti)
+
+'''
+This program samples hidden paths and emitted symbols from an HMM to make
+inputs of any size for the HMM scripts.
+
+The model is read with -m from a binary model or a file formatted for rosalind
+problem 22 (the observation section is ignored), or made at random with -k
+states and -l symbols. Sequences are sampled a chunk of positions at a time
+with whole-array operations, so millions of symbols take seconds.
+
+Output, to stdout:
+   decoding: the input of softDecoding.py (rosalind problem 22)
+   learning: the input of baum-WelchLearning.py and viterbiLearning.py
+      (rosalind problems 20 and 21), with the iteration count of -i
+   raw: only the symbols, for -o and the batch and stream modes
+Every sequence is one line of the observation section; baum-WelchLearning.py
+trains on all of them and the other scripts read the first.
+'''
+
+import os
+import sys
+import string
+import importlib.util
+import numpy as np
+
+
+def loadScript(name, fname) :
+   '''
+   Returns a script of this directory imported as a module, the scripts are
+   loaded by path since their names are not valid module names
+   '''
+   path = os.path.join(os.path.dirname(os.path.abspath(__file__)), fname)
+   spec = importlib.util.spec_from_file_location(name, path)
+   module = importlib.util.module_from_spec(spec)
+   spec.loader.exec_module(module)
+   return module
+
+
+softDecoding = loadScript('softDecoding', 'softDecoding .py')
+
+
+class CommandLine() :
+   '''
+   Handle the command line, usage and help requests.
+
+   CommandLine uses argparse to parse the options given on the command line.
+
+   attributes:
+   myCommandLine.args is a dictionary which includes each of the available
+   command line arguments as myCommandLine.args['option']
+   '''
+
+   def __init__(self, inOpts=None) :
+      '''
+      CommandLine constructor.
+      Implements a parser to interpret the command line argv string using argparse.
+      '''
+      import argparse
+      self.parser = argparse.ArgumentParser(
+         description = 'Sample observations from an HMM in the input formats of the HMM scripts',
+         add_help = True, #default is True
+         prefix_chars = '-',
+         usage = '%(prog)s [options] > output'
+         )
+      self.parser.add_argument('-m', '--model', default='', action = 'store',
+         help='sample from this binary or rosalind formatted model instead of a random one')
+      self.parser.add_argument('-k', '--states', type=int, default=4, action = 'store',
+         help='states of a random model (default 4)')
+      self.parser.add_argument('-l', '--symbols', type=int, default=3, action = 'store',
+         help='alphabet size of a random model (default 3)')
+      self.parser.add_argument('--stay', type=float, default=0.0, action = 'store',
+         help='extra probability of a random model staying in its state (default 0)')
+      self.parser.add_argument('-n', '--length', type=int, default=1000, action = 'store',
+         help='symbols in each sequence (default 1000)')
+      self.parser.add_argument('--min-length', type=int, default=None, action = 'store',
+         help='draw each length between this and --length instead')
+      self.parser.add_argument('-c', '--count', type=int, default=1, action = 'store',
+         help='number of sequences (default 1)')
+      self.parser.add_argument('-f', '--format', default='decoding', choices=['decoding', 'learning', 'raw'], action = 'store',
+         help='the input format written to stdout (default decoding)')
+      self.parser.add_argument('-i', '--iterations', type=int, default=100, action = 'store',
+         help='iteration count of the learning format (default 100)')
+      self.parser.add_argument('--start', default='model', choices=['model', 'random'], action = 'store',
+         help='matrices written with the observations: the sampled model or random ones to learn from')
+      self.parser.add_argument('--paths', default='', action = 'store',
+         help='write the hidden states of each sequence to this file, one line per sequence')
+      self.parser.add_argument('--save', default='', action = 'store',
+         help='write the sampled model to this file in the binary model format')
+      self.parser.add_argument('--seed', type=int, default=None, action = 'store',
+         help='seed of the random model and the samples')
+      if inOpts is None :
+         self.args = vars(self.parser.parse_args())
+      else :
+         self.args = vars(self.parser.parse_args(inOpts))
+
+
+class Generator :
+   '''
+   Note:
+      Samples sequences from an HMM. For a chunk of positions every state
+      gets its next state from one uniform draw per position, which makes a
+      map of the k states for each position; a position that starts a
+      sequence maps every state to its initial state. The states of the
+      chunk are the running composition of the maps, built by doubling
+      (log2 of the chunk size take_along_axis steps), and the symbols are
+      drawn from the emission rows of the states by inverse CDF
+   Args:
+      alphabet: a list of the single character symbols
+      states: a list of the state names
+      transition: the k x k transition matrix
+      emission: the k x l emission matrix
+      initial: the starting probability of each state, equal when None
+      seed: the seed of the random draws
+   '''
+
+   def __init__(self, alphabet, states, transition, emission, initial=None, seed=None) :
+      '''
+      Stores the model and its cumulative rows
+      '''
+      k = len(states)
+      self.alphabet = alphabet
+      self.states = states
+      self.transition = np.asarray(transition, float)
+      self.emission = np.asarray(emission, float)
+      self.initial = np.full(k, 1/k) if initial is None else np.asarray(initial, float)
+      self.rng = np.random.default_rng(seed)
+      self.cumTransition = np.cumsum(self.transition, axis=1)
+      self.cumEmission = np.cumsum(self.emission, axis=1)
+      self.cumInitial = np.cumsum(self.initial)
+      self.chunkSize = max(1<<10, (1<<22)//k) #keeps the k column maps near 4M entries
+
+
+   def sample(self, lengths) :
+      '''
+      Yields (states, symbols, ends) for consecutive chunks of the
+      concatenated sequences, ends being the chunk positions where a
+      sequence ends
+      '''
+      k = len(self.states)
+      lengths = np.asarray(lengths, np.int64)
+      starts = np.cumsum(lengths) - lengths
+      total = int(lengths.sum())
+      carry = 0
+      for begin in range(0, total, self.chunkSize):
+         end = min(begin + self.chunkSize, total)
+         first, last = np.searchsorted(starts, [begin, end])
+         reset = starts[first:last] - begin #chunk positions that start a sequence
+
+         #the map of every state to its next state at each position
+         draws = self.rng.random(end - begin)
+         maps = np.empty((end - begin, k), np.int64)
+         for s in range(k):
+            maps[:, s] = np.searchsorted(self.cumTransition[s], draws, side='right')
+         maps[reset] = np.searchsorted(self.cumInitial, self.rng.random(len(reset)), side='right')[:, np.newaxis]
+         np.minimum(maps, k - 1, out=maps) #a row summing to slightly under 1
+
+         #running composition, maps[t] becomes map t applied after maps 0 to t-1
+         step = 1
+         while step < len(maps):
+            maps[step:] = np.take_along_axis(maps[step:], maps[:-step], axis=1)
+            step *= 2
+         path = maps[:, carry]
+         carry = path[-1]
+
+         symbols = (self.cumEmission[path] <= self.rng.random(len(path))[:, np.newaxis]).sum(axis=1)
+         np.minimum(symbols, len(self.alphabet) - 1, out=symbols)
+         ends = np.searchsorted(starts + lengths, [begin, end], side='right')
+         yield path, symbols, (starts + lengths)[ends[0]:ends[1]] - begin
+
+
+   def lengths(self, count, length, minLength=None) :
+      '''
+      Returns the length of each sequence, all length or drawn between
+      minLength and length, and at least 1
+      '''
+      if minLength is None:
+         return np.full(count, max(length, 1))
+      return self.rng.integers(max(minLength, 1), max(length, minLength, 1) + 1, count)
+
+
+   def write(self, fileH, chunks, pathH=None) :
+      '''
+      Writes the symbols of the chunks with a newline at the end of each
+      sequence, and the states to pathH when given
+      '''
+      if pathH and max(len(state) for state in self.states) > 1:
+         raise ValueError('paths are written for single character state names')
+      symbolBytes = np.frombuffer(''.join(self.alphabet).encode(), np.uint8)
+      stateBytes = np.frombuffer(''.join(self.states).encode(), np.uint8) if pathH else None
+      for path, symbols, ends in chunks:
+         fileH.write(np.insert(symbolBytes[symbols], ends, ord('\n')).tobytes())
+         if pathH:
+            pathH.write(np.insert(stateBytes[path], ends, ord('\n')).tobytes())
+
+
+def randomModel(k, l, stay=0.0, rng=None) :
+   '''
+   Returns the alphabet, states, transition and emission of a random model,
+   the rows drawn uniformly and stay added to staying in the same state
+   '''
+   symbols = string.ascii_lowercase + string.ascii_uppercase + string.digits
+   if l > len(symbols):
+      raise ValueError('at most {0} symbols'.format(len(symbols)))
+   if k > 26:
+      raise ValueError('at most 26 states')
+   rng = rng or np.random.default_rng()
+   transition = (1 - stay)*rng.dirichlet(np.ones(k), k) + stay*np.eye(k)
+   emission = rng.dirichlet(np.ones(l), k)
+   return list(symbols[:l]), list(string.ascii_uppercase[:k]), transition, emission
+
+
+def printMatrix(fileH, columns, rows, matrix) :
+   '''
+   Writes a matrix in the rosalind format, a header of the columns and a row
+   for each of rows
+   '''
+   fileH.write('   ' + ' '.join(columns) + '\n')
+   for name, row in zip(rows, matrix.tolist()):
+      fileH.write(name + '  ' + ' '.join(repr(v) for v in row) + '\n')
+
+
+def main(myCommandLine=None) :
+
+   if myCommandLine is None:
+      myCommandLine = CommandLine()
+   args = myCommandLine.args
+   rng = np.random.default_rng(args['seed'])
+
+   # the model to sample from
+   initial = None
+   if args['model'] != '':
+      modelFile = softDecoding.ModelFile(args['model'])
+      if modelFile.isModel():
+         modelFile.read()
+         alphabet, states, transition, emission = modelFile.alphabet, modelFile.states, modelFile.transition, modelFile.emission
+         initial = modelFile.initial
+      else:
+         matrices = softDecoding.FileReader(args['model']).readFile()
+         alphabet, states = matrices[1][0], matrices[2][0]
+         transition = np.array([row[1:] for row in matrices[3][1:]], float)
+         emission = np.array([row[1:] for row in matrices[4][1:]], float)
+   else:
+      alphabet, states, transition, emission = randomModel(args['states'], args['symbols'], args['stay'], rng)
+   generator = Generator(alphabet, states, transition, emission, initial, rng.integers(1<<63))
+
+   if args['save'] != '':
+      softDecoding.ModelFile(args['save']).write(states, alphabet, transition, emission, initial,
+         {'program': 'hmmGenerator', 'seed': args['seed']})
+
+   out = sys.stdout
+   if args['format'] == 'learning':
+      out.write('{0}\n--------\n'.format(args['iterations']))
+   out.flush()
+   pathH = open(args['paths'], 'wb') if args['paths'] != '' else None
+   chunks = generator.sample(generator.lengths(args['count'], args['length'], args['min_length']))
+   generator.write(sys.stdout.buffer, chunks, pathH)
+   sys.stdout.buffer.flush()
+   if pathH:
+      pathH.close()
+   if args['format'] == 'raw':
+      return
+
+   # the matrices, of the model or random ones to learn from
+   if args['start'] == 'random':
+      transition, emission = randomModel(len(states), len(alphabet), rng=rng)[2:]
+   out.write('--------\n' + ' '.join(alphabet) + '\n--------\n' + ' '.join(states) + '\n--------\n')
+   printMatrix(out, states, states, np.asarray(transition))
+   out.write('--------\n')
+   printMatrix(out, alphabet, states, np.asarray(emission))
+
+
+if __name__ == "__main__":
+   main()
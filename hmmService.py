@@ -0,0 +1,353 @@
+#!/usr/bin/env python3
+# Max Genetti (mgenetti)
+
+'''
+This program keeps trained HMMs in memory and answers decode, posterior and
+likelihood requests over a Unix domain socket or a localhost TCP port, so a
+pipeline pays the NumPy import and the model parsing once instead of per call.
+
+Each model is a binary model file or a file formatted for rosalind problem 22
+(the observation section is ignored), read with the ModelFile or FileReader
+of softDecoding.py and named on the command line with -m NAME=FILE.
+
+Requests and replies are one JSON object per line:
+   {"op": "posterior", "model": NAME, "observation": "xyxzz"}
+      -> {"states": [...], "posterior": [[...], ...], "logLikelihood": -7.2}
+   {"op": "likelihood", "model": NAME, "observation": "xyxzz"}
+      -> {"logLikelihood": -7.2}
+   {"op": "decode", "model": NAME, "observation": "xyxzz"}
+      -> {"path": "ABBAA"}
+   {"op": "load", "model": NAME, "file": FILE}
+      -> {"model": NAME}
+   {"op": "models"}
+      -> {"models": [...]}
+A request that fails is answered with {"error": message}, and an "id" given
+in a request is copied to its reply.
+'''
+
+import os
+import sys
+import json
+import queue
+import signal
+import threading
+import socketserver
+import importlib.util
+from concurrent.futures import Future
+
+
+def loadScript(name, fname) :
+   '''
+   Returns a script of this directory imported as a module, the scripts are
+   loaded by path since their names are not valid module names
+   '''
+   path = os.path.join(os.path.dirname(os.path.abspath(__file__)), fname)
+   spec = importlib.util.spec_from_file_location(name, path)
+   module = importlib.util.module_from_spec(spec)
+   spec.loader.exec_module(module)
+   return module
+
+
+softDecoding = loadScript('softDecoding', 'softDecoding .py')
+viterbiLearning = loadScript('viterbiLearning', 'viterbiLearning.py')
+
+
+class CommandLine() :
+   '''
+   Handle the command line, usage and help requests.
+
+   CommandLine uses argparse to parse the options given on the command line.
+
+   attributes:
+   myCommandLine.args is a dictionary which includes each of the available
+   command line arguments as myCommandLine.args['option']
+   '''
+
+   def __init__(self, inOpts=None) :
+      '''
+      CommandLine constructor.
+      Implements a parser to interpret the command line argv string using argparse.
+      '''
+      import argparse
+      self.parser = argparse.ArgumentParser(
+         description = 'Serve decode, posterior and likelihood requests for HMMs kept in memory',
+         add_help = True, #default is True
+         prefix_chars = '-',
+         usage = '%(prog)s [options]'
+         )
+      self.parser.add_argument('-m', '--model', default=[], action = 'append',
+         help='load the binary or rosalind formatted model FILE as NAME=FILE, may be repeated')
+      self.parser.add_argument('-u', '--unix', default='', action = 'store',
+         help='listen on this Unix domain socket')
+      self.parser.add_argument('-p', '--port', type=int, default=8022, action = 'store',
+         help='listen on this localhost TCP port when no socket is given (default 8022)')
+      self.parser.add_argument('-b', '--batch', type=int, default=256, action = 'store',
+         help='the most waiting requests of a model decoded together (default 256)')
+      self.parser.add_argument('-s', '--sparse', action = 'store_true', default = False,
+         help='multiply through only the nonzero transitions, for large mostly forbidden models')
+      if inOpts is None :
+         self.args = vars(self.parser.parse_args())
+      else :
+         self.args = vars(self.parser.parse_args(inOpts))
+
+
+class Model :
+   '''
+   Note:
+      Holds one model and the worker thread that answers its requests.
+      Requests wait on a queue, the worker takes every waiting request up
+      to batchSize at once and runs the posterior and likelihood requests
+      through one BatchDecoder block, so concurrent callers share the
+      padded forward and backward passes. Only the worker touches the HMM
+      objects, so they need no locks. A request that fails, whatever the
+      error, gets the error as its reply and the worker goes on; close ends
+      the worker once the requests before it are answered
+   Args:
+      name: the name requests use for the model
+      fname: a binary model or a rosalind formatted file of the alphabet,
+         states and matrices
+      batchSize: the most requests decoded together
+      sparse: use the sparse transition products of the HMM classes
+   '''
+
+   def __init__(self, name, fname, batchSize=256, sparse=False) :
+      '''
+      Parses the model once into a soft decoding and a viterbi HMM and starts
+      the worker
+      '''
+      self.name = name
+      self.batchSize = batchSize
+      model = softDecoding.ModelFile(fname)
+      if model.isModel():
+         model.read()
+         alphabet, states, transition, emission = model.alphabet, model.states, model.transition, model.emission
+      else:
+         matrices = softDecoding.FileReader(fname).readFile()
+         alphabet, states, transition, emission = matrices[1][0], matrices[2][0], matrices[3], matrices[4]
+      self.hmm = softDecoding.HMM('', alphabet, states, transition, emission, sparse=sparse, initial=model.initial)
+      self.viterbi = viterbiLearning.HMM(0, '', alphabet, states, transition, emission, sparse=sparse, initial=model.initial)
+      self.decoder = softDecoding.BatchDecoder(self.hmm, batchSize=1<<22)
+      self.requests = queue.Queue()
+      self.closed = False
+      self.lock = threading.Lock()
+      self.worker = threading.Thread(target=self.work, name='model-' + name, daemon=True)
+      self.worker.start()
+
+
+   def submit(self, op, observation) :
+      '''
+      Encodes the observation and queues it, returning a Future of the reply
+      '''
+      future = Future()
+      codes = self.hmm.encoder.encode(observation) #a bad symbol fails here, in the caller
+      if len(codes) == 0:
+         raise ValueError('empty observation')
+      with self.lock:
+         if self.closed:
+            raise KeyError('model {0} was replaced'.format(self.name))
+         self.requests.put((op, codes, future))
+      return future
+
+
+   def close(self) :
+      '''
+      Stops taking requests and ends the worker after the waiting ones
+      '''
+      with self.lock:
+         self.closed = True
+         self.requests.put(None)
+
+
+   def work(self) :
+      '''
+      Answers the queued requests a batch at a time, until the None that
+      close queues
+      '''
+      running = True
+      while running:
+         batch = [self.requests.get()]
+         while len(batch) < self.batchSize:
+            try:
+               batch.append(self.requests.get_nowait())
+            except queue.Empty:
+               break
+         if None in batch:
+            running = False
+            batch = [request for request in batch if request is not None]
+
+         try:
+            self.answerBatch(batch)
+         except Exception as error:
+            # nothing may end the worker, the requests left waiting get the error
+            for op, codes, future in batch:
+               if not future.done():
+                  future.set_exception(error)
+
+
+   def answerBatch(self, batch) :
+      '''
+      Answers the decode requests of a batch one at a time and the others
+      through one BatchDecoder block
+      '''
+      soft = [request for request in batch if request[0] != 'decode']
+      for request in batch:
+         if request[0] == 'decode':
+            self.answer(request, self.decode)
+      if soft:
+         try:
+            results = self.decoder.decodeBlock([request[1] for request in soft])
+         except Exception:
+            # one zero probability (or otherwise failing) observation fails the block, answer one at a time
+            for request in soft:
+               self.answer(request, lambda codes: self.decoder.decodeBlock([codes])[0])
+         else:
+            for request, result in zip(soft, results):
+               self.answer(request, lambda codes: result)
+
+
+   def answer(self, request, compute) :
+      '''
+      Sets the reply of a request from compute(codes), or its error
+      '''
+      op, codes, future = request
+      try:
+         result = compute(codes)
+      except Exception as error:
+         future.set_exception(error)
+         return
+      if op == 'decode':
+         future.set_result({'path': result})
+      elif op == 'likelihood':
+         future.set_result({'logLikelihood': result[1]})
+      else:
+         future.set_result({'states': self.hmm.states, 'posterior': result[0].tolist(), 'logLikelihood': result[1]})
+
+
+   def decode(self, codes) :
+      '''
+      Returns the viterbi path of the codes
+      '''
+      self.viterbi.obsArray = codes
+      self.viterbi.viterbi()
+      return self.viterbi.convertOutput(self.viterbi.pathIndex)
+
+
+class Service :
+   '''
+   Note:
+      The named models of the server and the dispatch of each request
+   Args:
+      batchSize: the most requests of a model decoded together
+      sparse: use the sparse transition products
+   '''
+
+   def __init__(self, batchSize=256, sparse=False) :
+      '''
+      Starts with no models
+      '''
+      self.batchSize = batchSize
+      self.sparse = sparse
+      self.models = {}
+      self.lock = threading.Lock()
+
+
+   def load(self, name, fname) :
+      '''
+      Loads a model, replacing any model of the same name, whose worker is
+      stopped once its waiting requests are answered
+      '''
+      model = Model(name, fname, self.batchSize, self.sparse)
+      with self.lock:
+         previous = self.models.get(name)
+         self.models[name] = model
+      if previous is not None:
+         previous.close()
+
+
+   def handle(self, line) :
+      '''
+      Returns the reply to one JSON request line
+      '''
+      request = {}
+      try:
+         request = json.loads(line)
+         if not isinstance(request, dict):
+            raise ValueError('a request is a JSON object')
+         op = request.get('op')
+         if op == 'models':
+            reply = {'models': sorted(self.models)}
+         elif op == 'load':
+            self.load(request['model'], request['file'])
+            reply = {'model': request['model']}
+         elif op in ('decode', 'posterior', 'likelihood'):
+            if request.get('model') not in self.models:
+               raise KeyError('no model named {0}'.format(request.get('model')))
+            reply = self.models[request['model']].submit(op, request['observation']).result()
+         else:
+            raise ValueError('unknown op {0}'.format(op))
+      except Exception as error:
+         reply = {'error': '{0}: {1}'.format(type(error).__name__, error)}
+      if isinstance(request, dict) and 'id' in request:
+         reply['id'] = request['id']
+      return json.dumps(reply)
+
+
+class RequestHandler(socketserver.StreamRequestHandler) :
+   '''
+   Answers each JSON line of a connection with one JSON line, each connection
+   runs in its own thread
+   '''
+
+   def handle(self) :
+      '''reads requests until the client closes the connection'''
+      for line in self.rfile:
+         if not line.strip():
+            continue
+         self.wfile.write(self.server.service.handle(line).encode() + b'\n')
+         self.wfile.flush()
+
+
+class UnixServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer) :
+   '''a threaded server on a Unix domain socket'''
+   daemon_threads = True
+
+
+class TCPServer(socketserver.ThreadingMixIn, socketserver.TCPServer) :
+   '''a threaded server on a localhost port'''
+   daemon_threads = True
+   allow_reuse_address = True
+
+
+def main(myCommandLine=None) :
+
+   if myCommandLine is None:
+      myCommandLine = CommandLine()
+
+   service = Service(myCommandLine.args['batch'], myCommandLine.args['sparse'])
+   for model in myCommandLine.args['model']:
+      name, fname = model.split('=', 1)
+      service.load(name, fname)
+
+   if myCommandLine.args['unix'] != '':
+      if os.path.exists(myCommandLine.args['unix']):
+         os.unlink(myCommandLine.args['unix'])
+      server = UnixServer(myCommandLine.args['unix'], RequestHandler)
+   else:
+      server = TCPServer(('127.0.0.1', myCommandLine.args['port']), RequestHandler)
+   server.service = service
+
+   print('serving', ', '.join(sorted(service.models)) or 'no models', 'on',
+      myCommandLine.args['unix'] or '127.0.0.1:{0}'.format(myCommandLine.args['port']), file=sys.stderr)
+   signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0)) #kill still removes the socket
+   try:
+      server.serve_forever()
+   except KeyboardInterrupt:
+      pass
+   finally:
+      server.server_close()
+      if myCommandLine.args['unix'] != '':
+         os.unlink(myCommandLine.args['unix'])
+
+
+if __name__ == "__main__":
+   main()
@@ -10,12 +10,75 @@ reader class FileReader.
 Given: A DNA string Text and an amino acid string Peptide.
 
 Return: All substrings of Text encoding Peptide (if any such substrings exist).
+
+With -p FILE the peptide line is ignored and every peptide of FILE, one per
+line, is searched for in one pass over the translated frames. Each match is
+printed as position (1 based, forward strand), strand, frame (1 based),
+peptide and DNA substring, separated by tabs.
+
+With -g FASTA the genome is a multi-record, line wrapped FASTA file read in
+chunks, so any size of genome is scanned in constant memory, and the peptide
+is given with --peptide or -p (stdin is not read). Each match is printed as
+above after the name of its record. With -j N the chunks are scanned by N
+processes reading the file through its faidx index, which needs the lines of
+each record wrapped to one length.
+
+With -g FASTA --index FILE the genome is written to FILE as a 2-bit genome
+store instead, which -g then takes in place of the FASTA file and maps without
+parsing.
 '''
 
+import os
 import sys
+import json
+import mmap
+import shutil
+import multiprocessing
+from collections import deque
 import numpy as np
 
 
+class CommandLine() :
+   '''
+   Handle the command line, usage and help requests.
+
+   CommandLine uses argparse to parse the options given on the command line.
+
+   attributes:
+   myCommandLine.args is a dictionary which includes each of the available
+   command line arguments as myCommandLine.args['option']
+   '''
+
+   def __init__(self, inOpts=None) :
+      '''
+      CommandLine constructor.
+      Implements a parser to interpret the command line argv string using argparse.
+      '''
+      import argparse
+      self.parser = argparse.ArgumentParser(
+         description = 'Find the substrings of a genome encoding a peptide',
+         add_help = True, #default is True
+         prefix_chars = '-',
+         usage = '%(prog)s [options] < input > output'
+         )
+      self.parser.add_argument('-p', '--peptides', default='', action = 'store',
+         help='search for every peptide of this file, one per line, instead of the input peptide')
+      self.parser.add_argument('-g', '--genome', default='', action = 'store',
+         help='scan this FASTA file in chunks instead of the genome of the input')
+      self.parser.add_argument('--peptide', default='', action = 'store',
+         help='the peptide to search for in the -g genome')
+      self.parser.add_argument('--chunk', type=int, default=1<<22, action = 'store',
+         help='bases of a -g genome scanned at a time (default 4194304)')
+      self.parser.add_argument('--index', default='', action = 'store',
+         help='write the -g FASTA genome to this file as a 2-bit genome store and exit')
+      self.parser.add_argument('-j', '--processes', type=int, default=1, action = 'store',
+         help='number of worker processes scanning the chunks of a -g genome (default 1)')
+      if inOpts is None :
+         self.args = vars(self.parser.parse_args())
+      else :
+         self.args = vars(self.parser.parse_args(inOpts))
+
+
 
 class FileReader :
    '''
@@ -45,15 +108,405 @@ class FileReader :
       sequence = ''
       peptide = ''
       with self.doOpen() as fileH:
-         sequence = fileH.readline()
-         peptide = fileH.readline()
+         sequence = fileH.readline().strip()
+         peptide = fileH.readline().strip()
       return sequence, peptide
 
+   def readPeptides (self) :
+      '''
+      parses a list of peptides, the first word of each line, skipping empty
+      lines and > header lines
+      '''
+      peptides = []
+      with self.doOpen() as fileH:
+         for line in fileH:
+            words = line.split()
+            if words and not words[0].startswith('>'):
+               peptides.append(words[0].upper())
+      return peptides
+
+   def readChunks (self, chunkSize=1<<22, overlap=0) :
+      '''
+      Yields (name, offset, chunk, final) for a FASTA file, the bases of each
+      record a chunk at a time. Chunks of a record start every chunkSize
+      bases and repeat the first overlap bases of the next chunk, offset is
+      the 0 based start of the chunk in its record and final marks the last
+      chunk of a record. Bases before any header are a record named ''
+      '''
+      with self.doOpen() as fileH:
+         name = None
+         buffer = []
+         size = 0
+         offset = 0
+         for line in fileH:
+            if line.startswith('>'):
+               if name is not None:
+                  yield name, offset, ''.join(buffer), True
+               words = line[1:].split()
+               name = words[0] if words else ''
+               buffer, size, offset = [], 0, 0
+               continue
+            line = line.strip()
+            if not line:
+               continue
+            if name is None:
+               name = ''
+            buffer.append(line)
+            size += len(line)
+            while size > chunkSize + overlap:
+               bases = ''.join(buffer)
+               yield name, offset, bases[:chunkSize + overlap], False
+               buffer = [bases[chunkSize:]]
+               size -= chunkSize
+               offset += chunkSize
+         if name is not None:
+            yield name, offset, ''.join(buffer), True
+
+
+class FastaIndex :
+   '''
+   Note:
+      The faidx index of a FASTA file: for each record its name, length in
+      bases, the byte offset of its first base, and the bases and bytes of
+      each of its lines, which must all be the same but the last. An
+      existing fname.fai, as written by samtools faidx, is read instead of
+      scanning the file
+   Args:
+      fname: a FASTA file
+   '''
+
+   def __init__(self, fname) :
+      '''
+      Reads or builds the index of the records
+      '''
+      self.fname = fname
+      fai = fname + '.fai'
+      if os.path.exists(fai) and os.path.getmtime(fai) >= os.path.getmtime(fname):
+         with open(fai) as fileH:
+            self.records = [(fields[0],) + tuple(int(field) for field in fields[1:5])
+               for fields in (line.split('\t') for line in fileH) if len(fields) >= 5]
+      else:
+         self.records = self.build()
+
+
+   def build(self) :
+      '''
+      Returns the records of one pass over the file, a ValueError when a
+      record has lines of different lengths
+      '''
+      records = []
+      with open(self.fname, 'rb') as fileH:
+         position = 0
+         record = None
+         for line in fileH:
+            if line.startswith(b'>'):
+               if record:
+                  records.append(tuple(record[:5]))
+               words = line[1:].split()
+               record = [words[0].decode() if words else '', 0, position + len(line), 0, 0, False]
+            elif record is not None:
+               bases = len(line.rstrip(b'\r\n'))
+               if bases and record[5]:
+                  raise ValueError('record {0} has lines of different lengths'.format(record[0]))
+               if record[3] == 0:
+                  record[3], record[4] = bases, len(line)
+               elif bases != record[3] or len(line) != record[4]:
+                  record[5] = True #the last line of the record, or an error if more bases follow
+               record[1] += bases
+            position += len(line)
+         if record:
+            records.append(tuple(record[:5]))
+      return records
+
+
+   def chunks(self, chunkSize=1<<22, overlap=0) :
+      '''
+      Yields (record, start, end, final) for the chunks of every record as
+      FileReader.readChunks makes them, record being its index
+      '''
+      return chunkTasks([record[1] for record in self.records], chunkSize, overlap)
+
+
+   def map(self) :
+      '''
+      Returns the file mapped into memory, for fetch
+      '''
+      with open(self.fname, 'rb') as fileH:
+         return mmap.mmap(fileH.fileno(), 0, access=mmap.ACCESS_READ)
+
+
+   def fetch(self, data, record, start, end) :
+      '''
+      Returns the bases start to end of a record from data, the file mapped
+      or read into memory
+      '''
+      name, length, offset, lineBases, lineBytes = self.records[record]
+      if end <= start:
+         return ''
+      first = offset + (start//lineBases)*lineBytes + start % lineBases
+      last = offset + ((end - 1)//lineBases)*lineBytes + (end - 1) % lineBases + 1
+      return data[first:last].translate(None, b'\r\n').decode('ascii')
+
+
+class GenomeFile :
+   '''
+   Note:
+      A 2-bit genome store, the layout of the binary model of
+      softDecoding.py. The file starts with the magic GENOME2B, a uint16
+      version and the uint32 length of a JSON header holding the record
+      table and the offset, shape and type of each array, which follow on
+      64 byte boundaries. packed holds 4 bases a byte, the first in the high
+      bits, each record starting on a new byte; masks holds the [start, end)
+      runs of bases that are not ACGT (N and other codes, all read back as
+      N), a record taking rows first to last. Case is not kept
+   Args:
+      fname: the genome store
+   Returns:
+      read fills records, a list of (name, length, byte offset, first mask,
+      last mask), and metadata
+   '''
+
+   magic = b'GENOME2B'
+   version = 1
+
+   def __init__ (self, fname) :
+      '''constructor: saves attribute fname'''
+      self.fname = fname
+      self.records = []
+      self.metadata = {}
+
+
+   def isGenome (self) :
+      '''
+      Returns whether the file starts with the magic of a genome store
+      '''
+      with open(self.fname, 'rb') as fileH:
+         return fileH.read(len(self.magic)) == self.magic
+
+
+   def read (self) :
+      '''
+      Reads the header, returns self; the arrays are mapped by map
+      '''
+      with open(self.fname, 'rb') as fileH:
+         prefix = fileH.read(len(self.magic) + 6)
+         if prefix[:len(self.magic)] != self.magic:
+            raise ValueError('{0} is not a genome store'.format(self.fname))
+         version, headerLen = np.frombuffer(prefix[len(self.magic):], dtype='<u2,<u4')[0].tolist()
+         if version > self.version:
+            raise ValueError('{0} is genome store version {1}, this reads up to {2}'.format(self.fname, version, self.version))
+         header = json.loads(fileH.read(headerLen))
+      self.records = [tuple(record) for record in header['records']]
+      self.metadata = header.get('metadata', {})
+      self.base = -(-(len(self.magic) + 6 + headerLen)//64)*64
+      self.arrays = header['arrays']
+      return self
+
+
+   def map (self) :
+      '''
+      Returns the packed bases and the mask runs mapped into memory, for
+      fetch
+      '''
+      arrays = []
+      for name in ('packed', 'masks'):
+         offset, shape, dtype = self.arrays[name]
+         if np.prod(shape) == 0:
+            arrays.append(np.zeros(shape, dtype)) #an empty map is an error
+         else:
+            arrays.append(np.memmap(self.fname, dtype, 'r', self.base + offset, tuple(shape)))
+      return tuple(arrays)
+
+
+   def chunks (self, chunkSize=1<<22, overlap=0) :
+      '''
+      Yields (record, start, end, final) for the chunks of every record as
+      FileReader.readChunks makes them, record being its index
+      '''
+      return chunkTasks([record[1] for record in self.records], chunkSize, overlap)
+
+
+   def fetch (self, data, record, start, end) :
+      '''
+      Returns the 2-bit codes of the bases start to end of a record from
+      the arrays of map, 4 for a masked base
+      '''
+      packed, masks = data
+      name, length, offset, first, last = self.records[record]
+      if end <= start:
+         return np.zeros(0, np.uint8)
+      block = np.asarray(packed[offset + start//4:offset + (end + 3)//4])
+      codes = np.empty((len(block), 4), np.uint8)
+      for i in range(4):
+         codes[:, i] = (block >> 2*(3 - i)) & 3
+      codes = codes.ravel()[start % 4:start % 4 + end - start]
+
+      #the mask runs overlapping the bases, marked through a running sum of their edges
+      runs = np.asarray(masks[first:last])
+      runs = runs[(runs[:, 1] > start) & (runs[:, 0] < end)]
+      if len(runs):
+         edges = np.zeros(end - start + 1, np.int64)
+         np.add.at(edges, np.maximum(runs[:, 0], start) - start, 1)
+         np.add.at(edges, np.minimum(runs[:, 1], end) - start, -1)
+         codes[np.cumsum(edges[:-1]) > 0] = 4
+      return codes
+
+
+   def sequence (self, data, record, start=0, end=None) :
+      '''
+      Returns the bases start to end of a record as a string, N where masked
+      '''
+      end = self.records[record][1] if end is None else end
+      return np.frombuffer(b'ACGTN', np.uint8)[self.fetch(data, record, start, end)].tobytes().decode('ascii')
+
+
+   def segments (self, data, record) :
+      '''
+      Yields (start, bases) for the runs of a record between its masks
+      '''
+      name, length, offset, first, last = self.records[record]
+      start = 0
+      for maskStart, maskEnd in np.asarray(data[1][first:last]).tolist() + [[length, length]]:
+         if maskStart > start:
+            yield start, self.sequence(data, record, start, maskStart)
+         start = maskEnd
+
+
+   def write (self, fasta, metadata=None) :
+      '''
+      Packs the records of a FASTA file a chunk at a time into a temporary
+      file, then writes the header and copies the bases after it, the last
+      file replacing fname
+      '''
+      encoder = PeptideSearch('', '')
+      records = []
+      masks = []
+      size = 0
+      temp = self.fname + '.tmp'
+      with open(temp + '.bases', 'wb') as dataH:
+         for name, start, chunk, final in FileReader(fasta).readChunks(1<<22, 0):
+            if start == 0:
+               records.append([name, 0, size, len(masks), len(masks)])
+            codes = encoder.encode(chunk)
+            masked = codes > 3
+            edges = np.flatnonzero(np.diff(np.concatenate(([0], masked.view(np.int8), [0]))))
+            for runStart, runEnd in (edges.reshape(-1, 2) + start).tolist():
+               if masks and runStart == start and records[-1][4] > records[-1][3] and masks[-1][1] == start:
+                  masks[-1][1] = runEnd #a run across chunks
+               else:
+                  masks.append([runStart, runEnd])
+            records[-1][1] += len(codes)
+            records[-1][4] = len(masks)
+
+            #chunks of readChunks are a multiple of 4 bases, only the last of a record is padded
+            codes = np.where(masked, 0, codes)
+            codes = np.concatenate((codes, np.zeros(-len(codes) % 4, np.uint8))).reshape(-1, 4)
+            packed = (codes[:, 0] << 6) | (codes[:, 1] << 4) | (codes[:, 2] << 2) | codes[:, 3]
+            dataH.write(packed.astype(np.uint8).tobytes())
+            size += len(packed)
+
+      arrays = {'packed': (0, [size], '<u1'), 'masks': (-(-size//64)*64, [len(masks), 2], '<i8')}
+      header = json.dumps({'records': records, 'arrays': arrays, 'metadata': metadata or {}}).encode()
+      prefix = self.magic + np.array([(self.version, len(header))], dtype='<u2,<u4').tobytes() + header
+      base = -(-len(prefix)//64)*64
+      with open(temp, 'wb') as fileH:
+         fileH.write(prefix + bytes(base - len(prefix)))
+         with open(temp + '.bases', 'rb') as dataH:
+            shutil.copyfileobj(dataH, fileH, 1<<22)
+         fileH.seek(base + arrays['masks'][0])
+         fileH.write(np.array(masks, '<i8').reshape(-1, 2).tobytes())
+      os.remove(temp + '.bases')
+      os.replace(temp, self.fname)
+
+
+class PeptideAutomaton :
+   '''
+   Note:
+      An Aho-Corasick automaton of a list of peptides. The trie of the
+      peptides is completed breadth first into a table of the next state for
+      every state and amino acid, following the failure links, so a scan is
+      one table lookup per amino acid whatever the number of peptides. Each
+      state keeps the peptides ending there, those of its failure chain
+      included. Amino acids of no peptide (X, stops) return to the root
+   Args:
+      peptides: a list of peptide strings, repeats are searched once
+   '''
+
+   def __init__(self, peptides) :
+      '''
+      Builds the trie and its transition table
+      '''
+      self.peptides = list(dict.fromkeys(peptide for peptide in peptides if peptide))
+      letters = sorted(set(''.join(self.peptides)))
+      width = len(letters) + 1 #column 0 is every byte of no peptide
+
+      #the column of each byte, for bytes.translate
+      column = bytearray(256)
+      for i, letter in enumerate(letters):
+         column[ord(letter)] = i + 1
+      self.column = bytes(column)
+
+      children = [{}]
+      outputs = [[]]
+      for index, peptide in enumerate(self.peptides):
+         state = 0
+         for c in peptide.encode().translate(self.column):
+            if c not in children[state]:
+               children[state][c] = len(children)
+               children.append({})
+               outputs.append([])
+            state = children[state][c]
+         outputs[state].append(index)
+
+      #breadth first, the failure state of a child is shallower and already complete
+      table = [None]*len(children)
+      fail = [0]*len(children)
+      table[0] = [children[0].get(c, 0) for c in range(width)]
+      waiting = deque(children[0].values())
+      while waiting:
+         state = waiting.popleft()
+         row = list(table[fail[state]])
+         for c, child in children[state].items():
+            if state:
+               fail[child] = table[fail[state]][c]
+            outputs[child] += outputs[fail[child]]
+            row[c] = child
+            waiting.append(child)
+         table[state] = row
+      self.table = table
+      self.outputs = [tuple(output) for output in outputs]
+
+
+   def scan(self, text) :
+      '''
+      Yields (end, index) for every occurrence in the bytes text of the
+      peptide at index, end being the position of its last amino acid. A
+      single peptide is found with bytes.find instead
+      '''
+      if len(self.peptides) == 1:
+         peptide = self.peptides[0].encode()
+         j = text.find(peptide)
+         while j != -1:
+            yield j + len(peptide) - 1, 0
+            j = text.find(peptide, j + 1) #overlapping matches
+         return
+      table = self.table
+      outputs = self.outputs
+      state = 0
+      for end, c in enumerate(text.translate(self.column)):
+         state = table[state][c]
+         if outputs[state]:
+            for index in outputs[state]:
+               yield end, index
+
 
 class PeptideSearch:
    '''
    Note:
-      This class finds the sequences in a DNA strand coding for a given peptide
+      This class finds the sequences in a DNA strand coding for a given peptide.
+      The sequence is 2-bit encoded once, translated in all six frames through
+      a 64 entry lookup array, and the peptide is found by searching the
+      translated frames
    Args:
       sequence: a string of A DNA sequence and
       peptide: a string of a peptide sequence
@@ -84,70 +537,283 @@ class PeptideSearch:
       'GTG': 'V', 'GCG': 'A', 'GAG': 'E', 'GGG': 'G'  # GxG
       }
       
-   dnaCodonTableCompliment = {
-      # DNA codon table of Reverse Compliments
-      
-      'AAA': 'F', 'AGA': 'S', 'ATA': 'Y', 'ACA': 'C',
-      'GAA': 'F', 'GGA': 'S', 'GTA': 'Y', 'GCA': 'C',
-      'TAA': 'L', 'TGA': 'S', 'TTA': '-', 'TCA': '-',
-      'CAA': 'L', 'CGA': 'S', 'CTA': '-', 'CCA': 'W',
-      
-      'AAG': 'L', 'AGG': 'P', 'ATG': 'H', 'ACG': 'R',
-      'GAG': 'L', 'GGG': 'P', 'GTG': 'H', 'GCG': 'R',
-      'TAG': 'L', 'TGG': 'P', 'TTG': 'Q', 'TCG': 'R',
-      'CAG': 'L', 'CGG': 'P', 'CTG': 'Q', 'CCG': 'R',
-      
-      'AAT': 'I', 'AGT': 'T', 'ATT': 'N', 'ACT': 'S',
-      'GAT': 'I', 'GGT': 'T', 'GTT': 'N', 'GCT': 'S',
-      'TAT': 'I', 'TGT': 'T', 'TTT': 'K', 'TCT': 'R',
-      'CAT': 'M', 'CGT': 'T', 'CTT': 'K', 'CCT': 'R',
-      
-      'AAC': 'V', 'AGC': 'A', 'ATC': 'D', 'ACC': 'G',
-      'GAC': 'V', 'GGC': 'A', 'GTC': 'D', 'GCC': 'G',
-      'TAC': 'V', 'TGC': 'A', 'TTC': 'E', 'TCC': 'G',
-      'CAC': 'V', 'CGC': 'A', 'CTC': 'E', 'CCC': 'G'
-      }
+   bases = 'ACGT' #the 2-bit code of each base, its complement is 3 - code
 
    def __init__(self, sequence, peptide) :
       '''
-      Stores sequence and peptide
+      Stores sequence and peptide and builds the lookup tables
       '''
       self.sequence = sequence
       self.peptide = peptide
 
+      #any byte that is not a base (N, newlines) gets 4, lower case bases are read as upper case
+      self.baseCode = np.full(256, 4, np.uint8)
+      for code, base in enumerate(PeptideSearch.bases):
+         self.baseCode[ord(base)] = self.baseCode[ord(base.lower())] = code
+
+      #the amino acid of each codon index 16*first + 4*second + third
+      self.aminoTable = np.zeros(64, np.uint8)
+      for codon, amino in PeptideSearch.dnaCodonTable.items():
+         index = sum(PeptideSearch.bases.index(base) << 2*(2 - i) for i, base in enumerate(codon))
+         self.aminoTable[index] = ord(amino)
+
+
+   def encode(self, sequence) :
+      '''
+      Returns the 2-bit code of each base of a string, 4 for anything else
+      '''
+      return self.baseCode[np.frombuffer(sequence.encode(), np.uint8)]
+
+
+   def translate(self, codes) :
+      '''
+      Returns the three frames of translated codes as bytes, a codon with a
+      base that is not ACGT translates to X
+      '''
+      frames = []
+      for frame in range(3):
+         codons = codes[frame:frame + 3*((len(codes) - frame)//3)].reshape(-1, 3)
+         index = (codons[:, 0].astype(np.intp) << 4) | (codons[:, 1] << 2) | codons[:, 2]
+         amino = self.aminoTable[index & 63]
+         amino[(codons > 3).any(axis=1)] = ord('X')
+         frames.append(amino.tobytes())
+      return frames
+
+
+   def sixFrames(self, codes) :
+      '''
+      Returns the translations of both strands as a list of (strand, frame,
+      bytes), the reverse frames read from the reverse complement
+      '''
+      reverse = np.where(codes < 4, 3 - codes, codes)[::-1]
+      frames = [('+', frame, amino) for frame, amino in enumerate(self.translate(codes))]
+      frames += [('-', frame, amino) for frame, amino in enumerate(self.translate(reverse))]
+      return frames
+
+
+   def search(self) :
+      '''
+      Returns the matches of the peptide in the six frames as a list of
+      (position, strand, frame, DNA) in order of position, forward strand
+      first. position is the 0 based start on the forward strand, frame the
+      0 based offset of the codons on their strand, and DNA the forward
+      strand substring
+      '''
+      n = len(self.sequence)
+      size = 3*len(self.peptide)
+      peptide = self.peptide.encode()
+      hits = []
+      for strand, frame, amino in self.sixFrames(self.encode(self.sequence)):
+         j = amino.find(peptide)
+         while j != -1:
+            start = frame + 3*j if strand == '+' else n - frame - 3*j - size
+            hits.append((start, strand, frame, self.sequence[start:start + size]))
+            j = amino.find(peptide, j + 1) #overlapping matches
+      hits.sort(key=lambda hit: (hit[0], hit[1] == '-'))
+      return hits
+
+
+   def locate(self, codes, automaton) :
+      '''
+      Returns (start, strand, index) for every match in the six frames of
+      the codes of a peptide of a PeptideAutomaton, start being the 0 based
+      position on the forward strand of the codes
+      '''
+      n = len(codes)
+      found = []
+      for strand, frame, amino in self.sixFrames(codes):
+         for end, index in automaton.scan(amino):
+            length = len(automaton.peptides[index])
+            j = end - length + 1
+            found.append((frame + 3*j if strand == '+' else n - frame - 3*j - 3*length, strand, index))
+      return found
+
+
+   def searchAll(self, automaton) :
+      '''
+      Returns the matches of all peptides of a PeptideAutomaton in one scan
+      of each of the six frames, as a list of (position, strand, frame, DNA,
+      peptide) ordered as in search and then by the order of the peptides
+      '''
+      n = len(self.sequence)
+      rank = {peptide: i for i, peptide in enumerate(automaton.peptides)}
+      hits = []
+      for start, strand, index in self.locate(self.encode(self.sequence), automaton):
+         size = 3*len(automaton.peptides[index])
+         frame = start % 3 if strand == '+' else (n - start - size) % 3
+         hits.append((start, strand, frame, self.sequence[start:start + size], automaton.peptides[index]))
+      hits.sort(key=lambda hit: (hit[0], hit[1] == '-', rank[hit[4]]))
+      return hits
+
+
+   def chunkHits(self, offset, chunk, final, automaton, overlap) :
+      '''
+      Returns (position, strand, DNA, index) for the matches of a chunk of a
+      record that start in its own bases, position being in the record. The
+      chunk is a string or the 2-bit codes of a GenomeFile. The last overlap
+      bases of a chunk that is not final belong to the next chunk, which
+      finds the matches starting there
+      '''
+      if isinstance(chunk, str):
+         codes = self.encode(chunk)
+      else:
+         codes, chunk = chunk, np.frombuffer(b'ACGTN', np.uint8)[chunk].tobytes().decode('ascii')
+      owned = len(chunk) if final else len(chunk) - overlap
+      hits = []
+      for start, strand, index in self.locate(codes, automaton):
+         if start < owned:
+            hits.append((offset + start, strand, chunk[start:start + 3*len(automaton.peptides[index])], index))
+      return hits
+
+
+   def recordHits(self, name, n, hits, automaton) :
+      '''
+      Yields (name, position, strand, frame, DNA, peptide) for the matches
+      of a whole record of n bases, in the order of searchAll
+      '''
+      hits.sort(key=lambda hit: (hit[0], hit[1] == '-', hit[3]))
+      for start, strand, dna, index in hits:
+         frame = start % 3 if strand == '+' else (n - start - len(dna)) % 3
+         yield name, start, strand, frame, dna, automaton.peptides[index]
+
+
+   def searchChunks(self, chunks, automaton, overlap) :
+      '''
+      Yields (name, position, strand, frame, DNA, peptide) for the matches
+      of a PeptideAutomaton in chunks of FileReader.readChunks, a record at
+      a time in the order of searchAll. overlap must be at least 3 times the
+      longest peptide less 1, so a match crossing into the next chunk is
+      whole in this one. The matches of a record are held until its end,
+      where its length gives the frames of the reverse strand
+      '''
+      hits = []
+      for name, offset, chunk, final in chunks:
+         hits += self.chunkHits(offset, chunk, final, automaton, overlap)
+         if final:
+            yield from self.recordHits(name, offset + len(chunk), hits, automaton)
+            hits = []
+
+
+   def searchParallel(self, index, automaton, overlap, chunkSize=1<<22, processes=1) :
+      '''
+      Yields the matches of searchChunks for the records of a FastaIndex or
+      GenomeFile, the chunks scanned in a pool of processes, or in this one
+      for 1. Each worker maps the file and reads its chunks from the map,
+      so only the chunk coordinates and the matches are sent between
+      processes, and the results are taken in the order of the chunks,
+      which keeps the output the same for any number of processes
+      '''
+      tasks = list(index.chunks(chunkSize, overlap))
+      if not tasks:
+         return
+      if processes > 1:
+         pool = multiprocessing.Pool(min(processes, len(tasks)), initializer=initScan,
+            initargs=(index, self, automaton, overlap))
+         results = pool.imap(scanChunk, tasks)
+      else:
+         pool = None
+         initScan(index, self, automaton, overlap)
+         results = map(scanChunk, tasks)
+      try:
+         hits = []
+         for task, found in zip(tasks, results):
+            hits += found
+            record, offset, end, final = task
+            if final:
+               name, n = index.records[record][:2]
+               yield from self.recordHits(name, n, hits, automaton)
+               hits = []
+      finally:
+         if pool:
+            pool.terminate()
+
 
    def parseSequence(self):
       '''
       Note:
-         This method returns the sequences coding for the peptide in both 
+         This method prints the sequences coding for the peptide in both
          the forward and reverse strands.
       '''
+      if not self.peptide:
+         return
+      for position, strand, frame, dna in self.search():
+         print(dna)
+
+
+scanState = {}
+
+
+def chunkTasks(lengths, chunkSize=1<<22, overlap=0) :
+   '''
+   Yields (record, start, end, final) for the chunks of records of the
+   given lengths as FileReader.readChunks makes them, record being its index
+   '''
+   for record, length in enumerate(lengths):
+      start = 0
+      while length - start > chunkSize + overlap:
+         yield record, start, start + chunkSize + overlap, False
+         start += chunkSize
+      yield record, start, length, True
+
+
+def initScan(index, search, automaton, overlap) :
+   '''
+   Maps the file of a FastaIndex or GenomeFile into a worker process
+   '''
+   scanState['data'] = index.map()
+   scanState['scan'] = (index, search, automaton, overlap)
 
-      p = len(self.peptide)
-
-      for i in range(len(self.sequence)-(p*3-1)): #iterate through sequence
-         
-         seq = ''
-         for j in range(0, p): #Check Forward Strand
-            if(PeptideSearch.dnaCodonTable[self.sequence[i+(3*j):i+(3*j)+3]] == self.peptide[j]):
-               #checks forward strand
-               seq += self.sequence[i+(3*j):i+(3*j)+3]
-               if(j == p-1):
-                  print(seq)
-            else:
-               break
-
-         seq = ''
-         for j in range(0, p): #Check Reverse Compliment
-            if(PeptideSearch.dnaCodonTableCompliment[self.sequence[i+(3*j):i+(3*j)+3]] == self.peptide[-(j+1)]):
-               #checks peptide in reverse
-               seq += self.sequence[i+(3*j):i+(3*j)+3]
-               if(j == p-1):
-                  print(seq)
-            else:
-               break
-
-def main() :
+
+def scanChunk(task) :
+   '''
+   Returns the matches of one chunk of FastaIndex.chunks or
+   GenomeFile.chunks, run inside a worker process or the parent
+   '''
+   index, search, automaton, overlap = scanState['scan']
+   record, start, end, final = task
+   chunk = index.fetch(scanState['data'], record, start, end)
+   return search.chunkHits(start, chunk, final, automaton, overlap)
+
+
+def main(myCommandLine=None) :
+
+   if myCommandLine is None:
+      myCommandLine = CommandLine()
+   args = myCommandLine.args
+   out = sys.stdout
+
+   # a FASTA genome packed once into a genome store
+   if args['index'] != '':
+      if args['genome'] == '':
+         myCommandLine.parser.error('--index needs the -g FASTA genome')
+      GenomeFile(args['index']).write(args['genome'], {'program': 'proteinDecoder', 'source': args['genome']})
+      return
+
+   # a FASTA genome read a chunk at a time, or a genome store
+   if args['genome'] != '':
+      if args['peptides'] != '':
+         peptides = FileReader(args['peptides']).readPeptides()
+      elif args['peptide'] != '':
+         peptides = [args['peptide'].upper()]
+      else:
+         myCommandLine.parser.error('-g needs --peptide or -p')
+      automaton = PeptideAutomaton(peptides)
+      if not automaton.peptides:
+         return
+      overlap = 3*max(len(peptide) for peptide in automaton.peptides) - 1
+      store = GenomeFile(args['genome'])
+      if store.isGenome():
+         hits = PeptideSearch('', '').searchParallel(store.read(), automaton, overlap,
+            max(args['chunk'], 1), args['processes'])
+      elif args['processes'] > 1:
+         hits = PeptideSearch('', '').searchParallel(FastaIndex(args['genome']), automaton, overlap,
+            max(args['chunk'], 1), args['processes'])
+      else:
+         chunks = FileReader(args['genome']).readChunks(max(args['chunk'], 1), overlap)
+         hits = PeptideSearch('', '').searchChunks(chunks, automaton, overlap)
+      for name, position, strand, frame, dna, peptide in hits:
+         out.write('{0}\t{1}\t{2}\t{3}\t{4}\t{5}\n'.format(name, position + 1, strand, frame + 1, peptide, dna))
+      return
 
    # read file and store as matrices
    fileReader = FileReader('')
@@ -155,7 +821,14 @@ def main() :
 
    # initialize hmm object and print the probability
    seqs = PeptideSearch(sequence, peptide)
-   seqs.parseSequence()
+   if args['peptides'] == '':
+      seqs.parseSequence()
+      return
+
+   # one automaton of the whole list, one pass over each frame
+   automaton = PeptideAutomaton(FileReader(args['peptides']).readPeptides())
+   for position, strand, frame, dna, peptide in seqs.searchAll(automaton):
+      out.write('{0}\t{1}\t{2}\t{3}\t{4}\n'.format(position + 1, strand, frame + 1, peptide, dna))
 
 
 if __name__ == "__main__":
@@ -16,8 +16,62 @@ Return: The probability Pr(πi = k|x) that the HMM was in state k at step i
 (for each state k and each step i). 
 '''
 
+import os
 import sys
+import json
 import numpy as np
+try:
+   import numba #optional, compiles the recursion loops
+except ImportError:
+   numba = None
+
+
+class CommandLine() :
+   '''
+   Handle the command line, usage and help requests.
+
+   CommandLine uses argparse to parse the options given on the command line.
+   The rosalind formatted input is still read from stdin.
+
+   attributes:
+   myCommandLine.args is a dictionary which includes each of the available
+   command line arguments as myCommandLine.args['option']
+   '''
+
+   def __init__(self, inOpts=None) :
+      '''
+      CommandLine constructor.
+      Implements a parser to interpret the command line argv string using argparse.
+      '''
+      import argparse
+      self.parser = argparse.ArgumentParser(
+         description = 'Posterior probability of each state at each position of an HMM observation',
+         add_help = True, #default is True
+         prefix_chars = '-',
+         usage = '%(prog)s [options] < input > output'
+         )
+      self.parser.add_argument('-o', '--observation', default='', action = 'store',
+         help='memory map the observation from this file instead of the observation section of the input')
+      self.parser.add_argument('--output', default='', action = 'store',
+         help='write the posteriors to this file, .npy or .npz as NumPy files and any other name as raw float64 rows')
+      self.parser.add_argument('-d', '--digits', type=int, default=None, action = 'store',
+         help='significant digits of the text output (default the full precision)')
+      self.parser.add_argument('-b', '--batch', action = 'store_true', default = False,
+         help='decode each line of stdin as an observation against the model read from --model')
+      self.parser.add_argument('-m', '--model', default='', action = 'store',
+         help='read the rosalind formatted input from this file instead of stdin, or a binary model with the observation on stdin')
+      self.parser.add_argument('-r', '--region', default=[], action = 'append',
+         help='only decode positions START-END (1 based, inclusive), may be repeated')
+      self.parser.add_argument('--precision', type=int, default=64, choices=[32, 64], action = 'store',
+         help='bits of the floats of the matrices and tables (default 64)')
+      self.parser.add_argument('--backend', default='auto', choices=['auto', 'numpy', 'numba'], action = 'store',
+         help='run the recursions as NumPy calls or as Numba compiled loops (default numba when installed)')
+      self.parser.add_argument('-s', '--sparse', action = 'store_true', default = False,
+         help='multiply through only the nonzero transitions, for large mostly forbidden models')
+      if inOpts is None :
+         self.args = vars(self.parser.parse_args())
+      else :
+         self.args = vars(self.parser.parse_args(inOpts))
 
 
 class FileReader :
@@ -59,35 +113,193 @@ class FileReader :
       return matrices
 
 
+class Observation :
+   '''
+   Note:
+      Encodes an observation into the alphabet index of each symbol once,
+      through a 256 entry lookup table applied to the raw bytes, so the same
+      codes can be reused by every decoding and training call. A file is
+      read through a memory map, whitespace and newlines are skipped
+   Args:
+      alphabet: a list of the single character symbols of a hmm
+      observation: a string or bytes of the observed symbols
+      fname: a file of observed symbols to memory map instead
+   Returns:
+      codes: an array of the alphabet index of each symbol
+   '''
+
+   def __init__ (self, alphabet, observation='', fname='') :
+      '''
+      Builds the lookup table and encodes the observation or file
+      '''
+      self.alphabet = alphabet
+      codeType = np.uint8 if len(alphabet) < 254 else np.uint16
+      self.bad = np.iinfo(codeType).max
+      self.space = self.bad - 1
+      self.lookup = np.full(256, self.bad, dtype=codeType)
+      for i, symbol in enumerate(alphabet):
+         self.lookup[ord(symbol)] = i
+      for symbol in b' \t\r\n':
+         self.lookup[symbol] = self.space
+
+      if fname != '':
+         observation = np.memmap(fname, np.uint8, 'r') if os.path.getsize(fname) else b''
+      self.codes = self.encode(observation)
+
+
+   def __len__ (self) :
+      '''the number of symbols'''
+      return len(self.codes)
+
+
+   def encode (self, raw, chunkSize=1<<24) :
+      '''
+      Returns the alphabet index of each symbol of a string, bytes or byte
+      array, looked up a chunk at a time so a memory mapped file is never
+      copied whole
+      '''
+      if isinstance(raw, str):
+         raw = raw.encode()
+      if isinstance(raw, bytes):
+         raw = np.frombuffer(raw, np.uint8)
+      pieces = []
+      for start in range(0, len(raw), chunkSize):
+         codes = self.lookup[raw[start:start + chunkSize]]
+         codes = codes[codes != self.space]
+         if (codes == self.bad).any():
+            raise ValueError('observation has a symbol not in the alphabet')
+         pieces.append(codes)
+      if not pieces:
+         return np.zeros(0, self.lookup.dtype)
+      return np.concatenate(pieces)
+
+
+class ModelFile :
+   '''
+   Note:
+      A versioned binary HMM. The file starts with the magic HMMBIN, a
+      uint16 version and the uint32 length of a JSON header holding the
+      states, alphabet, training metadata and the offset and shape of each
+      array. The float64 arrays follow, each on a 64 byte boundary, so they
+      are memory mapped by read instead of parsed or copied
+   Args:
+      fname: the model file
+   Returns:
+      read fills states, alphabet, transition, emission, initial (None when
+      the model has none) and metadata
+   '''
+
+   magic = b'HMMBIN'
+   version = 1
+
+   def __init__ (self, fname) :
+      '''constructor: saves attribute fname'''
+      self.fname = fname
+      self.initial = None
+      self.metadata = {}
+
+
+   def isModel (self) :
+      '''
+      Returns whether the file starts with the magic of a binary model
+      '''
+      with open(self.fname, 'rb') as fileH:
+         return fileH.read(len(self.magic)) == self.magic
+
+
+   def read (self) :
+      '''
+      Reads the header and maps the arrays, returns self
+      '''
+      with open(self.fname, 'rb') as fileH:
+         prefix = fileH.read(len(self.magic) + 6)
+         if prefix[:len(self.magic)] != self.magic:
+            raise ValueError('{0} is not a binary model'.format(self.fname))
+         version, headerLen = np.frombuffer(prefix[len(self.magic):], dtype='<u2,<u4')[0].tolist()
+         if version > self.version:
+            raise ValueError('{0} is model version {1}, this reads up to {2}'.format(self.fname, version, self.version))
+         header = json.loads(fileH.read(headerLen))
+      self.states = header['states']
+      self.alphabet = header['alphabet']
+      self.metadata = header.get('metadata', {})
+      base = -(-(len(self.magic) + 6 + headerLen)//64)*64
+      for name, (offset, shape) in header['arrays'].items():
+         setattr(self, name, np.memmap(self.fname, '<f8', 'r', base + offset, tuple(shape)))
+      return self
+
+
+   def write (self, states, alphabet, transition, emission, initial=None, metadata=None) :
+      '''
+      Writes a model, through a temporary file that replaces fname so a
+      checkpoint being written never leaves a partial model behind
+      '''
+      arrays = {'transition': transition, 'emission': emission}
+      if initial is not None:
+         arrays['initial'] = initial
+      layout = {}
+      offset = 0
+      for name, array in arrays.items():
+         layout[name] = (offset, list(np.shape(array)))
+         offset += -(-np.size(array)*8//64)*64
+      header = json.dumps({'states': list(states), 'alphabet': list(alphabet),
+         'arrays': layout, 'metadata': metadata or {}}).encode()
+      prefix = self.magic + np.array([(self.version, len(header))], dtype='<u2,<u4').tobytes() + header
+      base = -(-len(prefix)//64)*64
+
+      temp = self.fname + '.tmp'
+      with open(temp, 'wb') as fileH:
+         fileH.write(prefix + bytes(base - len(prefix)))
+         for name, array in arrays.items():
+            fileH.seek(base + layout[name][0])
+            fileH.write(np.ascontiguousarray(array, '<f8').tobytes())
+      os.replace(temp, self.fname)
+
+
 class HMM:
    '''
    Args:
-      observation: a string of the observation
+      observation: a string or Observation of the observation
       alphabet: a list of the alphabet in a hmm
       states: a list of the states in a hmm
       transitionList: a list of lists containing the transition matrix
       emissionList: a list of lists containing the emission matrix
+      sparse: run forward and backward through only the nonzero transitions
+         with a SparseTransition
+      initial: the starting probability of each state, equal when None
+      dtype: the float type of the matrices and the tables, np.float32
+         halves their memory
+      backend: the kernels that run the recursions, see chooseKernels
    Returns:
       A list of the probability of the states at each position in the observation
    '''
 
-   def __init__(self, observation, alphabet, states, transitionMatrixList, emissionMatrixList) :
+   def __init__(self, observation, alphabet, states, transitionMatrixList, emissionMatrixList, sparse=False, initial=None, dtype=np.float64, backend='auto') :
       '''
       Stores observation, alphabet, states and then builds the matrices
       '''
       self.observation = observation
       self.alphabet = alphabet
       self.states = states
+      self.dtype = np.dtype(dtype)
       self.transition = self.buildMatrix(transitionMatrixList)
       self.emission = self.buildMatrix(emissionMatrixList)
+      self.initial = np.full(len(states), 1/len(states), self.dtype) if initial is None else np.asarray(initial, self.dtype)
+      self.sparse = sparse
+      if sparse:
+         self.sparseTransition = SparseTransition(self.transition)
+      self.kernels = chooseKernels(backend, sparse)
+      self.encoder = Observation(alphabet)
       self.observationIndex = self.convertObservation()
-      self.len = len(self.observation)
+      self.len = len(self.observationIndex)
 
 
    def buildMatrix(self, matrixList) :
       '''
-      creates in the numpy array of the matrix
+      creates in the numpy array of the matrix, an array (such as the memory
+      mapped matrices of a ModelFile) is used as it is when it has the dtype
       '''
+      if isinstance(matrixList, np.ndarray):
+         return np.asarray(matrixList, self.dtype)
       m = []
       #iterate through, skipping the list and first item in each following list
       for i in range(1,len(matrixList)):
@@ -95,80 +307,630 @@ class HMM:
       #append new lines for each row of the matrix
       m = np.array(m)
       #set alll the values to float
-      matrix = m.astype(np.float)
+      matrix = m.astype(self.dtype)
       return matrix
 
 
    def convertObservation (self) :
       '''
-      iterate through observation storing alphabet index in list
-      Returns the numeric equivalent of the observation
+      Returns the numeric equivalent of the observation, reusing the codes of
+      an Observation
       '''
-      num = []
-      for i in self.observation:
-         num.append(self.alphabet.index(i))
-      return num
+      if isinstance(self.observation, Observation):
+         return self.observation.codes
+      return self.encoder.encode(self.observation)
 
 
 
    def forward(self):
       '''
-      calculates the probability of the sequence
+      Calculates the scaled forward table of the sequence
+      Returns:
+         fwd: an n x k array of forward probabilities, each row scaled to sum 1
+         scale: the n scaling constants, log Pr(x) is the sum of their logs
       '''
-      observed = self.convertObservation()   #convert observed into numberic representation
-      prior = 1/len(self.states)   #starting probability of that state
-      
-      #create empty array to hold calculations for each poisition in the observation
-      fwd=np.zeros((len(self.observation),len(self.states)))   
-      
-      #initializes with the starting probability prior
-      fwd[0]=prior*self.emission[:,observed[0]]   
-     
-      #Iterate through multiplying the probability for each position
-      for t in range(len(self.observation)-1):   
-         fwd[t+1]=np.dot(fwd[t],self.transition)*self.emission[:,observed[t+1]]
-      #returns the sum
-      return fwd, fwd[-1].sum()
+      chunks = list(self.forwardChunks())
+      fwd = np.concatenate([chunk[1] for chunk in chunks])
+      scale = np.concatenate([chunk[2] for chunk in chunks])
+      return fwd, scale
+
+
+   def forwardChunks(self, chunkSize=1<<16, begin=0, end=None, previous=None):
+      '''
+      Runs the forward recursion a chunk of positions at a time
+      Note:
+         each row is normalized to sum to 1 and the normalizing constant is
+         kept, so long observations no longer underflow to zero
+      Args:
+         chunkSize: the positions in each chunk
+         begin, end: the positions to run over, end defaults to the length
+         previous: the scaled forward row at begin - 1, None at position 0
+      Returns:
+         the start position, scaled forward rows and scaling constants of
+         each chunk
+      '''
+      emission = np.ascontiguousarray(self.emission.T) #one row of emission probabilities per symbol
+      prior = self.initial   #starting probability of each state
+      end = self.len if end is None else end
+
+      for start in range(begin, end, chunkSize):
+         observed = self.observationIndex[start:min(start + chunkSize, end)]
+         fwd = np.zeros((len(observed), len(self.states)), self.dtype)
+         scale = np.zeros(len(observed), self.dtype)
+
+         first = 0
+         if previous is None:
+            row = prior*emission[observed[0]] #initializes with the starting probability prior
+            scale[0] = row.sum()
+            previous = fwd[0] = row/max(scale[0], np.finfo(self.dtype).tiny)
+            first = 1
+
+         #Iterate through multiplying the probability for each position, stopping at a zero
+         self.kernels.forward(self, emission, observed[first:], previous, fwd[first:], scale[first:])
+         zero = np.flatnonzero(scale <= 0)
+         if len(zero):
+            raise ValueError('observation has zero probability at position {0}'.format(start + zero[0] + 1))
+         previous = fwd[-1]
+         yield start, fwd, scale
 
 
    def backward(self):
       '''
       Calculates the backwords probability from a given observation using the
-      emission and transition matrices
-      '''
-      obsArray = np.array(self.observationIndex) #converts the observation into an Array
-      matrix = np.zeros((self.len, len(self.states))) #creates an empty matrix
-      for i in range(len(self.states)): #iterates through states storing positions in matrix
-         matrix[self.len - 1, i] = 1
-      for i in reversed(range(self.len - 1)): #iterates through the observation in reverse
-         matrix[i] = np.dot(matrix[i + 1] * self.emission[:, obsArray[i + 1]], self.transition.T)
+      emission and transition matrices, each row scaled to sum to 1
+      '''
+      return self.backwardRange(0, self.len)
+
+
+   def backwardRange(self, begin, end, following=None):
+      '''
+      Calculates the scaled backwords rows of positions begin to end
+      Args:
+         following: the scaled backward row at end, None when end is the length
+      '''
+      obsArray = self.observationIndex #the observation as an Array
+      emission = np.ascontiguousarray(self.emission.T) #one row of emission probabilities per symbol
+      matrix = np.zeros((end - begin, len(self.states)), self.dtype) #creates an empty matrix
+      if following is None:
+         following = np.full(len(self.states), 1/len(self.states), self.dtype)
+         end -= 1
+         matrix[end - begin] = following
+      #iterates through the observation in reverse
+      self.kernels.backward(self, emission, obsArray[begin + 1:end + 1], following, matrix[:end - begin])
       return matrix
 
 
-   def output(self):
+   def posteriors(self, chunkSize=1<<16):
       '''
-      Calculates the probability for the states at each position 
-      Note: Recieved help from Alex Bagi on this method
+      Yields the probability of each state at each position a chunk of rows
+      at a time, running forward alongside so only the backward table is held
+      '''
+      bwd = self.backward()
+      for start, fwd, scale in self.forwardChunks(chunkSize):
+         prob = fwd * bwd[start:start + len(fwd)]
+         prob /= prob.sum(axis=1, keepdims=True)
+         yield prob
+
+
+   def transitionDot(self, x) :
+      '''
+      Returns x times the transition matrix, through only its nonzero entries
+      in sparse mode
+      '''
+      if self.sparse:
+         return self.sparseTransition.dot(x)
+      return np.dot(x, self.transition)
+
+
+   def transitionDotT(self, x) :
+      '''
+      Returns x times the transposed transition matrix, through only its
+      nonzero entries in sparse mode
+      '''
+      if self.sparse:
+         return self.sparseTransition.dotT(x)
+      return np.dot(x, self.transition.T)
+
+
+   def windows(self, intervals, every=None):
       '''
-      fwd = self.forward() #calculate forward probability
-      bwd = self.backward() #calculate reverse probability
+      Calculates the probability of the states only in the given intervals
+      Note:
+         forward and backward are run once storing a row only every
+         every positions (the square root of the length by default), then
+         each interval is recomputed from the checkpoints around it, so
+         memory follows the intervals plus O(k*sqrt(n)) instead of n
+      Args:
+         intervals: a list of (start, stop) positions, 0 based and half open
+      Returns:
+         a list with the stop - start x k posteriors of each interval
+      '''
+      every = every or max(1, int(np.ceil(np.sqrt(self.len))))
+      segments = (self.len - 1)//every + 1
+
+      #forward row before the start of each segment
+      fwdCheck = [None]
+      for start, fwd, scale in self.forwardChunks(every):
+         fwdCheck.append(fwd[-1])
+
+      #backward row at the start of each segment, after the last is None
+      bwdCheck = [None]*(segments + 1)
+      for c in reversed(range(segments)):
+         rows = self.backwardRange(c*every, min((c + 1)*every, self.len), bwdCheck[c + 1])
+         bwdCheck[c] = rows[0]
+
+      posteriors = []
+      for start, stop in intervals:
+         if not 0 <= start < stop <= self.len:
+            raise ValueError('interval {0}-{1} (1 based) is outside the observation of {2} positions'.format(start + 1, stop, self.len))
+         c = start//every
+         fwd = np.concatenate([chunk[1] for chunk in self.forwardChunks(stop - c*every, c*every, stop, fwdCheck[c])])
+         c = -(-stop//every)
+         bwd = self.backwardRange(start, min(c*every, self.len), bwdCheck[c] if c*every < self.len else None)
+         prob = fwd[start - stop:] * bwd[:stop - start]
+         posteriors.append(prob/prob.sum(axis=1, keepdims=True))
+      return posteriors
 
-      prob = (fwd[0] * bwd) / fwd[1] #calculates the initial probability
 
+   def outputWindows(self, intervals, digits=None):
+      '''
+      Prints the probability of the states in each interval, with the 1 based
+      position of each row
+      '''
+      field = '%r' if digits is None else '%.{0}g'.format(digits)
+      rowFormat = '%d\t' + '\t'.join([field]*len(self.states)) + '\n'
+      print('position', *self.states, sep='\t')
+      for (start, stop), prob in zip(intervals, self.windows(intervals)):
+         rows = np.column_stack([np.arange(start + 1, stop + 1), prob]).tolist()
+         for row in rows:
+            row[0] = int(row[0])
+         sys.stdout.write((rowFormat*len(rows)) % tuple(i for row in rows for i in row))
+
+
+   def outputBatch(self, observations, fname='', digits=None):
+      '''
+      Decodes each observation with a BatchDecoder and prints a
+      >number<tab>log-likelihood line followed by its posteriors, or writes
+      an .npz archive of posterior_number arrays and the log-likelihoods
+      '''
+      decoder = BatchDecoder(self)
+      if fname != '':
+         arrays = {}
+         logLikelihoods = []
+         for i, (prob, logLikelihood) in enumerate(decoder.decode(observations)):
+            arrays['posterior_{0}'.format(i + 1)] = prob
+            logLikelihoods.append(logLikelihood)
+         np.savez(fname, logLikelihood=np.array(logLikelihoods), states=np.array(self.states), **arrays)
+         return
+
+      field = '%r' if digits is None else '%.{0}g'.format(digits)
+      rowFormat = '\t'.join([field]*len(self.states)) + '\n'
       print(*self.states, sep='\t') #prints states
-      for s in range(0, len(prob)): #prints the probability of each state
-         print('{0}'.format('\t'.join([str(number) for number in prob[s, :]])))
+      for i, (prob, logLikelihood) in enumerate(decoder.decode(observations)):
+         sys.stdout.write('>{0}\t{1!r}\n'.format(i + 1, logLikelihood))
+         sys.stdout.write((rowFormat*len(prob)) % tuple(prob.ravel().tolist()))
+
+
+   def output(self, fname='', digits=None):
+      '''
+      Calculates the probability for the states at each position and writes
+      it through a PosteriorWriter as each chunk of rows is computed
+      Note: Recieved help from Alex Bagi on this method
+      '''
+      writer = PosteriorWriter(self.states, self.len, fname, digits)
+      for prob in self.posteriors():
+         writer.write(prob)
+      writer.close()
+
+
+class PosteriorWriter :
+   '''
+   Note:
+      Writes posterior probabilities a chunk of rows at a time. A name ending
+      in .npy is written as a NumPy array through a memory map, .npz as a
+      NumPy archive of the posteriors and states, any other name as raw
+      float64 rows (read back with np.memmap(name, np.float64).reshape(-1, k))
+      and no name as tab separated text on stdout, formatted a chunk at a time
+   Args:
+      states: a list of the states in a hmm
+      rows: the number of positions that will be written
+      fname: the file to write to, stdout when empty
+      digits: the significant digits of the text, None for the full repr
+   '''
+
+   def __init__(self, states, rows, fname='', digits=None) :
+      '''
+      Opens the output and writes the states header of the text
+      '''
+      self.states = states
+      self.fname = fname
+      self.written = 0
+      self.chunks = []
+      if fname.endswith('.npy'):
+         self.table = np.lib.format.open_memmap(fname, mode='w+', dtype=np.float64, shape=(rows, len(states)))
+      elif fname.endswith('.npz'):
+         pass
+      elif fname != '':
+         self.fileH = open(fname, 'wb')
+      else:
+         field = '%r' if digits is None else '%.{0}g'.format(digits)
+         self.rowFormat = '\t'.join([field]*len(states)) + '\n'
+         print(*self.states, sep='\t') #prints states
+
+
+   def write(self, prob) :
+      '''
+      Writes the next chunk of rows
+      '''
+      if self.fname.endswith('.npy'):
+         self.table[self.written:self.written + len(prob)] = prob
+      elif self.fname.endswith('.npz'):
+         self.chunks.append(prob)
+      elif self.fname != '':
+         prob.astype(np.float64).tofile(self.fileH)
+      else:
+         sys.stdout.write((self.rowFormat*len(prob)) % tuple(prob.ravel().tolist()))
+      self.written += len(prob)
+
+
+   def close(self) :
+      '''
+      Flushes and closes the output
+      '''
+      if self.fname.endswith('.npy'):
+         self.table.flush()
+         del self.table
+      elif self.fname.endswith('.npz'):
+         prob = np.concatenate(self.chunks) if self.chunks else np.zeros((0, len(self.states)))
+         np.savez(self.fname, posterior=prob, states=np.array(self.states))
+      elif self.fname != '':
+         self.fileH.close()
+      else:
+         sys.stdout.flush()
+
+
+class BatchDecoder :
+   '''
+   Note:
+      Decodes a stream of observations against one loaded HMM. Observations
+      are read a block at a time, sorted by length into padded batches and
+      run through forward and backward as sequences x length x k arrays, so
+      each position is one NumPy step for the whole batch
+   Args:
+      hmm: the HMM whose matrices are used
+      blockSize: the observations read before they are bucketed by length
+      batchSize: the most padded positions (sequences x length) in a batch
+   Returns:
+      The posterior probabilities and log-likelihood of each observation, in
+      the order they were read
+   '''
+
+   def __init__(self, hmm, blockSize=4096, batchSize=1<<20) :
+      '''
+      Stores the hmm and the block and batch sizes
+      '''
+      self.hmm = hmm
+      self.blockSize = blockSize
+      self.batchSize = batchSize
+      self.emission = np.ascontiguousarray(hmm.emission.T) #one row of emission probabilities per symbol
+
+
+   def decode(self, observations) :
+      '''
+      Yields the k column posteriors and the log-likelihood of each
+      observation of an iterable of strings
+      '''
+      block = []
+      for observation in observations:
+         block.append(self.hmm.encoder.encode(observation))
+         if len(block) == self.blockSize:
+            yield from self.decodeBlock(block)
+            block = []
+      if block:
+         yield from self.decodeBlock(block)
+
+
+   def decodeBlock(self, block) :
+      '''
+      Decodes a block of encoded observations and returns the results in order
+      '''
+      results = [None]*len(block)
+      for members, batch, lengths in self.buildBatches(block):
+         fwd, scale = self.forward(batch, lengths)
+         bwd = self.backward(batch, lengths)
+         prob = fwd * bwd
+         prob /= np.where(prob.sum(axis=2, keepdims=True) > 0, prob.sum(axis=2, keepdims=True), 1)
+         logLikelihood = np.log(scale.astype(np.float64)).sum(axis=1) #summed in double precision
+         for row, i in enumerate(members):
+            results[i] = (prob[row, :lengths[row]], float(logLikelihood[row]))
+      for i in range(len(block)):
+         if results[i] is None: #an empty observation
+            results[i] = (np.zeros((0, len(self.hmm.states)), self.hmm.dtype), 0.0)
+      return results
+
+
+   def buildBatches(self, block) :
+      '''
+      Groups the observations of a block into padded 2-D arrays, longest first
+      Note:
+         a new batch starts once the batch would hold more than batchSize
+         positions or the next observation is less than half as long as the
+         first, rows are in decreasing length so the observations still running
+         at any position are always the leading rows
+      Returns:
+         a list of (block indices, batch, lengths)
+      '''
+      order = sorted((i for i in range(len(block)) if len(block[i])), key=lambda i: len(block[i]), reverse=True)
+      batches = []
+      start = 0
+      while start < len(order):
+         longest = len(block[order[start]])
+         stop = start + 1
+         while (stop < len(order) and (stop - start + 1)*longest <= self.batchSize
+                and 2*len(block[order[stop]]) >= longest):
+            stop += 1
+         members = order[start:stop]
+         lengths = np.array([len(block[i]) for i in members])
+         batch = np.zeros((len(members), longest), dtype=np.intp)
+         for row, i in enumerate(members):
+            batch[row, :lengths[row]] = block[i]
+         batches.append((members, batch, lengths))
+         start = stop
+      return batches
+
+
+   def forward(self, batch, lengths) :
+      '''
+      Calculates the scaled forward tables of a batch, padding keeps a scale of 1
+      '''
+      running = (lengths[np.newaxis, :] > np.arange(batch.shape[1])[:, np.newaxis]).sum(1) #observations still running at each position
+      fwd = np.zeros(batch.shape + (len(self.hmm.states),), self.hmm.dtype)
+      scale = np.ones(batch.shape, self.hmm.dtype)
+
+      row = self.hmm.initial*self.emission[batch[:, 0]]
+      scale[:, 0] = row.sum(1)
+      fwd[:, 0] = row/scale[:, 0, np.newaxis]
+      for t in range(1, batch.shape[1]):
+         m = running[t]
+         row = self.hmm.transitionDot(fwd[:m, t-1])*self.emission[batch[:m, t]]
+         scale[:m, t] = row.sum(1)
+         fwd[:m, t] = row/scale[:m, t, np.newaxis]
+
+      if not (scale > 0).all():
+         raise ValueError('observation has zero probability under the model')
+      return fwd, scale
+
+
+   def backward(self, batch, lengths) :
+      '''
+      Calculates the backwords tables of a batch, each row scaled to sum to 1
+      '''
+      running = (lengths[np.newaxis, :] > np.arange(batch.shape[1])[:, np.newaxis]).sum(1)
+      k = len(self.hmm.states)
+      matrix = np.zeros(batch.shape + (k,), self.hmm.dtype)
+      matrix[np.arange(len(lengths)), lengths - 1] = 1/k
+      for i in reversed(range(batch.shape[1] - 1)):
+         m = running[i + 1]
+         row = self.hmm.transitionDotT(self.emission[batch[:m, i + 1]]*matrix[:m, i + 1])
+         matrix[:m, i] = row/row.sum(1, keepdims=True)
+      return matrix
+
+
+class SparseTransition :
+   '''
+   Note:
+      Holds only the nonzero entries of a k x k transition matrix, in
+      compressed row (CSR) order and again in column order, so a product with
+      it costs the number of nonzero transitions instead of k*k. Banded and
+      profile models with thousands of mostly forbidden transitions gain the
+      most
+   Args:
+      matrix: the dense transition matrix
+   '''
+
+   def __init__(self, matrix) :
+      '''
+      Stores the nonzero entries and where each row and column starts
+      '''
+      self.k = len(matrix)
+      self.rows, self.cols = np.nonzero(matrix) #row major, so already in CSR order
+      self.values = matrix[self.rows, self.cols]
+      self.rowStarts = np.flatnonzero(np.diff(self.rows, prepend=-1))
+      self.rowIds = self.rows[self.rowStarts]
+
+      #the same entries ordered by column, rows still increasing within a column
+      order = np.argsort(self.cols, kind='stable')
+      self.colRows = self.rows[order]
+      self.colValues = self.values[order]
+      self.colStarts = np.flatnonzero(np.diff(self.cols[order], prepend=-1))
+      self.colIds = self.cols[order][self.colStarts]
+
+
+   def dot(self, x) :
+      '''
+      Returns x times the matrix for x with the states on its last axis
+      '''
+      out = np.zeros(x.shape[:-1] + (self.k,), np.result_type(x, self.values))
+      if len(self.values):
+         out[..., self.colIds] = np.add.reduceat(x[..., self.colRows]*self.colValues, self.colStarts, axis=-1)
+      return out
+
+
+   def dotT(self, x) :
+      '''
+      Returns x times the transposed matrix for x with the states on its last axis
+      '''
+      out = np.zeros(x.shape[:-1] + (self.k,), np.result_type(x, self.values))
+      if len(self.values):
+         out[..., self.rowIds] = np.add.reduceat(x[..., self.cols]*self.values, self.rowStarts, axis=-1)
+      return out
+
+
+class NumpyKernels :
+   '''
+   Note:
+      The reference recursions, one NumPy call per position. They work with
+      every transition product of an HMM, dense or sparse
+   '''
+
+   name = 'numpy'
+
+   def forward(self, hmm, emission, observed, previous, fwd, scale) :
+      '''
+      Fills the scaled forward rows and scaling constants of the observed
+      codes from the row before them, stopping at a zero probability
+      '''
+      for t, symbol in enumerate(observed.tolist()):
+         row = hmm.transitionDot(previous)*emission[symbol]
+         scale[t] = row.sum()
+         if scale[t] <= 0:
+            return
+         previous = fwd[t] = row/scale[t]
+
+
+   def backward(self, hmm, emission, observed, following, matrix) :
+      '''
+      Fills the scaled backward rows from the last back, row i from the
+      code observed[i] after it and the row following it
+      '''
+      for i in reversed(range(len(observed))):
+         row = hmm.transitionDotT(following * emission[observed[i]])
+         following = matrix[i] = row/row.sum()
+
+
+class LoopKernels :
+   '''
+   Note:
+      The recursions as plain loops over the states, compiled once with
+      Numba, so a position costs no Python calls. For the few states of
+      most models this is much faster than a NumPy call per position.
+      Only dense transition matrices are run this way
+   Args:
+      compile: the compiler of the loop functions, numba.njit by default
+   '''
+
+   name = 'numba'
+
+   def __init__(self, compile=None) :
+      '''
+      Compiles the loop functions
+      '''
+      compile = compile or numba.njit(cache=True)
+      self.forwardLoop = compile(forwardLoop)
+      self.backwardLoop = compile(backwardLoop)
+
+
+   def forward(self, hmm, emission, observed, previous, fwd, scale) :
+      '''the forward rows, as NumpyKernels.forward'''
+      transition = np.ascontiguousarray(hmm.transition)
+      self.forwardLoop(transition, emission, observed, np.array(previous), fwd, scale)
+
+
+   def backward(self, hmm, emission, observed, following, matrix) :
+      '''the backward rows, as NumpyKernels.backward'''
+      transition = np.ascontiguousarray(hmm.transition)
+      self.backwardLoop(transition, emission, observed, np.array(following), matrix)
+
+
+def forwardLoop(transition, emission, observed, previous, fwd, scale) :
+   '''
+   The scaled forward recursion of NumpyKernels.forward as loops
+   '''
+   k = transition.shape[0]
+   for t in range(len(observed)):
+      total = 0.0
+      for j in range(k):
+         acc = 0.0
+         for i in range(k):
+            acc += previous[i]*transition[i, j]
+         fwd[t, j] = acc*emission[observed[t], j]
+         total += fwd[t, j]
+      scale[t] = total
+      if total <= 0:
+         return
+      for j in range(k):
+         fwd[t, j] /= total
+      previous = fwd[t]
+
+
+def backwardLoop(transition, emission, observed, following, matrix) :
+   '''
+   The scaled backward recursion of NumpyKernels.backward as loops
+   '''
+   k = transition.shape[0]
+   weighted = np.empty(k, matrix.dtype)
+   for t in range(len(observed) - 1, -1, -1):
+      for j in range(k):
+         weighted[j] = following[j]*emission[observed[t], j]
+      total = 0.0
+      for i in range(k):
+         acc = 0.0
+         for j in range(k):
+            acc += transition[i, j]*weighted[j]
+         matrix[t, i] = acc
+         total += acc
+      for i in range(k):
+         matrix[t, i] /= total
+      following = matrix[t]
+
+
+def chooseKernels(backend='auto', sparse=False) :
+   '''
+   Returns the kernels of a backend: numpy, numba, or auto for numba when it
+   is installed. numba falls back to numpy, with a warning, without it or
+   for a sparse model, whose products only the numpy kernels run
+   '''
+   if sparse:
+      if backend == 'numba':
+         print('sparse models run on the numpy backend, ignoring --backend numba', file=sys.stderr)
+      return NumpyKernels()
+   if backend == 'numpy' or (backend == 'auto' and numba is None):
+      return NumpyKernels()
+   if numba is None:
+      print('numba is not installed, using the numpy backend', file=sys.stderr)
+      return NumpyKernels()
+   return LoopKernels()
+
 
+def main(myCommandLine=None) :
 
-def main() :
+   if myCommandLine is None:
+      myCommandLine = CommandLine()
 
-   # read file and store as matrices
-   fileReader = FileReader('')
-   matrices = fileReader.readFile()
+   # read file and store as matrices, a binary model is memory mapped
+   modelFile = ModelFile(myCommandLine.args['model'])
+   if myCommandLine.args['model'] != '' and modelFile.isModel():
+      modelFile.read()
+      alphabet, states, transition, emission = modelFile.alphabet, modelFile.states, modelFile.transition, modelFile.emission
+      observation = '' if myCommandLine.args['batch'] else sys.stdin.read()
+   else:
+      matrices = FileReader(myCommandLine.args['model']).readFile()
+      alphabet, states, transition, emission = matrices[1][0], matrices[2][0], matrices[3], matrices[4]
+      observation = matrices[0][0][0]
 
    # initialize hmm object and print the probability
-   hmm = HMM(matrices[0][0][0], matrices[1][0], matrices[2][0], matrices[3], matrices[4])
-   hmm.output()
+   if myCommandLine.args['observation'] != '':
+      observation = Observation(alphabet, fname=myCommandLine.args['observation'])
+   hmm = HMM(observation, alphabet, states, transition, emission,
+      sparse=myCommandLine.args['sparse'], initial=modelFile.initial,
+      dtype=np.float32 if myCommandLine.args['precision'] == 32 else np.float64,
+      backend=myCommandLine.args['backend'])
+   if myCommandLine.args['batch']:
+      # the observation of the model file is ignored, each line of stdin is decoded
+      hmm.outputBatch((line.strip() for line in sys.stdin), myCommandLine.args['output'], myCommandLine.args['digits'])
+   elif myCommandLine.args['region']:
+      intervals = []
+      for region in myCommandLine.args['region']:
+         bounds = region.split('-')
+         if len(bounds) != 2 or not all(bound.strip().isdigit() for bound in bounds):
+            myCommandLine.parser.error('-r {0}: a region is START-END, two positive integers'.format(region))
+         start, stop = int(bounds[0]), int(bounds[1])
+         if not 1 <= start <= stop <= hmm.len:
+            myCommandLine.parser.error('-r {0}: a region is within positions 1-{1} with START <= END'.format(region, hmm.len))
+         intervals.append((start - 1, stop))
+      hmm.outputWindows(intervals, myCommandLine.args['digits'])
+   else:
+      hmm.output(myCommandLine.args['output'], myCommandLine.args['digits'])
    
 
 
@@ -17,8 +17,66 @@ emission probabilities Emission that maximizes Pr(x, π) over all possible
 transition and emission matrices and over all hidden paths π. 
 '''
 
+import os
 import sys
+import json
 import numpy as np
+try:
+   import numba #optional, compiles the recursion loops
+except ImportError:
+   numba = None
+
+
+class CommandLine() :
+   '''
+   Handle the command line, usage and help requests.
+
+   CommandLine uses argparse to parse the options given on the command line.
+   The rosalind formatted input is still read from stdin.
+
+   attributes:
+   myCommandLine.args is a dictionary which includes each of the available
+   command line arguments as myCommandLine.args['option']
+   '''
+
+   def __init__(self, inOpts=None) :
+      '''
+      CommandLine constructor.
+      Implements a parser to interpret the command line argv string using argparse.
+      '''
+      import argparse
+      self.parser = argparse.ArgumentParser(
+         description = 'Viterbi learning of the transition and emission matrices of an HMM',
+         add_help = True, #default is True
+         prefix_chars = '-',
+         usage = '%(prog)s [options] < input > output'
+         )
+      self.parser.add_argument('-c', '--checkpoint', type=int, default=None, action = 'store',
+         help='decode in linear memory keeping the scores every N positions (0 for the square root of the length)')
+      self.parser.add_argument('-o', '--observation', default='', action = 'store',
+         help='memory map the observation from this file instead of the observation section of the input')
+      self.parser.add_argument('-s', '--sparse', action = 'store_true', default = False,
+         help='take the viterbi maximum over only the nonzero transitions, for large mostly forbidden models')
+      self.parser.add_argument('--stream', action = 'store_true', default = False,
+         help='after learning from --model, decode the symbols read from stdin as a stream')
+      self.parser.add_argument('-m', '--model', default='', action = 'store',
+         help='read the rosalind formatted input from this file instead of stdin')
+      self.parser.add_argument('-l', '--lag', type=int, default=1000, action = 'store',
+         help='positions of lookahead before a stream decision is forced (default 1000)')
+      self.parser.add_argument('--precision', type=int, default=64, choices=[32, 64], action = 'store',
+         help='bits of the floats of the matrices and viterbi scores (default 64)')
+      self.parser.add_argument('--backend', default='auto', choices=['auto', 'numpy', 'numba'], action = 'store',
+         help='run the viterbi recursion as NumPy calls or as a Numba compiled loop (default numba when installed)')
+      self.parser.add_argument('--resume', default='', action = 'store',
+         help='start from the states, alphabet and matrices of this binary model, continuing its iteration count')
+      self.parser.add_argument('--save', default='', action = 'store',
+         help='write the learned model to this file in the binary model format')
+      self.parser.add_argument('--save-every', type=int, default=0, action = 'store',
+         help='also write the --save model after every this many iterations, {0} in its name becomes the count')
+      if inOpts is None :
+         self.args = vars(self.parser.parse_args())
+      else :
+         self.args = vars(self.parser.parse_args(inOpts))
 
 
 class FileReader :
@@ -59,47 +117,217 @@ class FileReader :
       return matrices
 
 
+class Observation :
+   '''
+   Note:
+      Encodes an observation into the alphabet index of each symbol once,
+      through a 256 entry lookup table applied to the raw bytes, so the same
+      codes can be reused by every decoding and training call. A file is
+      read through a memory map, whitespace and newlines are skipped
+   Args:
+      alphabet: a list of the single character symbols of a hmm
+      observation: a string or bytes of the observed symbols
+      fname: a file of observed symbols to memory map instead
+   Returns:
+      codes: an array of the alphabet index of each symbol
+   '''
+
+   def __init__ (self, alphabet, observation='', fname='') :
+      '''
+      Builds the lookup table and encodes the observation or file
+      '''
+      self.alphabet = alphabet
+      codeType = np.uint8 if len(alphabet) < 254 else np.uint16
+      self.bad = np.iinfo(codeType).max
+      self.space = self.bad - 1
+      self.lookup = np.full(256, self.bad, dtype=codeType)
+      for i, symbol in enumerate(alphabet):
+         self.lookup[ord(symbol)] = i
+      for symbol in b' \t\r\n':
+         self.lookup[symbol] = self.space
+
+      if fname != '':
+         observation = np.memmap(fname, np.uint8, 'r') if os.path.getsize(fname) else b''
+      self.codes = self.encode(observation)
+
+
+   def __len__ (self) :
+      '''the number of symbols'''
+      return len(self.codes)
+
+
+   def encode (self, raw, chunkSize=1<<24) :
+      '''
+      Returns the alphabet index of each symbol of a string, bytes or byte
+      array, looked up a chunk at a time so a memory mapped file is never
+      copied whole
+      '''
+      if isinstance(raw, str):
+         raw = raw.encode()
+      if isinstance(raw, bytes):
+         raw = np.frombuffer(raw, np.uint8)
+      pieces = []
+      for start in range(0, len(raw), chunkSize):
+         codes = self.lookup[raw[start:start + chunkSize]]
+         codes = codes[codes != self.space]
+         if (codes == self.bad).any():
+            raise ValueError('observation has a symbol not in the alphabet')
+         pieces.append(codes)
+      if not pieces:
+         return np.zeros(0, self.lookup.dtype)
+      return np.concatenate(pieces)
+
+
+class ModelFile :
+   '''
+   Note:
+      A versioned binary HMM. The file starts with the magic HMMBIN, a
+      uint16 version and the uint32 length of a JSON header holding the
+      states, alphabet, training metadata and the offset and shape of each
+      array. The float64 arrays follow, each on a 64 byte boundary, so they
+      are memory mapped by read instead of parsed or copied
+   Args:
+      fname: the model file
+   Returns:
+      read fills states, alphabet, transition, emission, initial (None when
+      the model has none) and metadata
+   '''
+
+   magic = b'HMMBIN'
+   version = 1
+
+   def __init__ (self, fname) :
+      '''constructor: saves attribute fname'''
+      self.fname = fname
+      self.initial = None
+      self.metadata = {}
+
+
+   def isModel (self) :
+      '''
+      Returns whether the file starts with the magic of a binary model
+      '''
+      with open(self.fname, 'rb') as fileH:
+         return fileH.read(len(self.magic)) == self.magic
+
+
+   def read (self) :
+      '''
+      Reads the header and maps the arrays, returns self
+      '''
+      with open(self.fname, 'rb') as fileH:
+         prefix = fileH.read(len(self.magic) + 6)
+         if prefix[:len(self.magic)] != self.magic:
+            raise ValueError('{0} is not a binary model'.format(self.fname))
+         version, headerLen = np.frombuffer(prefix[len(self.magic):], dtype='<u2,<u4')[0].tolist()
+         if version > self.version:
+            raise ValueError('{0} is model version {1}, this reads up to {2}'.format(self.fname, version, self.version))
+         header = json.loads(fileH.read(headerLen))
+      self.states = header['states']
+      self.alphabet = header['alphabet']
+      self.metadata = header.get('metadata', {})
+      base = -(-(len(self.magic) + 6 + headerLen)//64)*64
+      for name, (offset, shape) in header['arrays'].items():
+         setattr(self, name, np.memmap(self.fname, '<f8', 'r', base + offset, tuple(shape)))
+      return self
+
+
+   def write (self, states, alphabet, transition, emission, initial=None, metadata=None) :
+      '''
+      Writes a model, through a temporary file that replaces fname so a
+      checkpoint being written never leaves a partial model behind
+      '''
+      arrays = {'transition': transition, 'emission': emission}
+      if initial is not None:
+         arrays['initial'] = initial
+      layout = {}
+      offset = 0
+      for name, array in arrays.items():
+         layout[name] = (offset, list(np.shape(array)))
+         offset += -(-np.size(array)*8//64)*64
+      header = json.dumps({'states': list(states), 'alphabet': list(alphabet),
+         'arrays': layout, 'metadata': metadata or {}}).encode()
+      prefix = self.magic + np.array([(self.version, len(header))], dtype='<u2,<u4').tobytes() + header
+      base = -(-len(prefix)//64)*64
+
+      temp = self.fname + '.tmp'
+      with open(temp, 'wb') as fileH:
+         fileH.write(prefix + bytes(base - len(prefix)))
+         for name, array in arrays.items():
+            fileH.seek(base + layout[name][0])
+            fileH.write(np.ascontiguousarray(array, '<f8').tobytes())
+      os.replace(temp, self.fname)
+
+
 class HMM:
    '''
    Args:
       iteration: an int for the number of iteraions
-      observation: a string of the observation
+      observation: a string or Observation of the observation
       alphabet: a list of the alphabet in a hmm
       states: a list of the states in a hmm
       transitionMatrixList: a list of lists containing the transition matrix
       emissionMtrixList: a list of lists containing the emission matrix
+      checkpoint: decode keeping the viterbi scores only every this many
+         positions instead of every backpointer, 0 for the square root of the
+         observation length
+      sparse: take the viterbi maximum over only the nonzero transitions
+         with a SparseTransition
+      initial: the starting probability of each state, equal when None. It
+         is kept as it is, only the matrices are learned
+      dtype: the float type of the matrices and the viterbi scores,
+         np.float32 halves their memory
+      backend: the kernels that run the recursion, see chooseKernels
+      save: a file the model is written to every saveEvery iterations
+      saveEvery: how often to checkpoint the model, 0 for never
    Returns:
       A matrix of transition probabilities and a matrix of emission
       probabilities
    '''
 
-   def __init__(self, iteration, observation, alphabet, states, transitionMatrixList, emissionMatrixList) :
+   def __init__(self, iteration, observation, alphabet, states, transitionMatrixList, emissionMatrixList, checkpoint=None, sparse=False, initial=None, save='', saveEvery=0, dtype=np.float64, backend='auto') :
       '''Stores iteration, observation, alphabet, states and then builds the matrices'''
       self.iteration = iteration
       self.observation = observation
       self.alphabet = alphabet
       self.states = states
-      self.path = ''
+      self.checkpoint = checkpoint
+      self.sparse = sparse
+      self.save = save
+      self.saveEvery = saveEvery
+      self.completed = 0   #iterations run, including those of a resumed model
+      self.dtype = np.dtype(dtype)
       self.transition = self.buildMatrix(transitionMatrixList)
       self.emission = self.buildMatrix(emissionMatrixList)
+      self.initial = np.full(len(states), 1/len(states), self.dtype) if initial is None else np.asarray(initial, self.dtype)
+      self.kernels = chooseKernels(backend, sparse)
+      self.encoder = Observation(alphabet)
+      self.obsArray = self.convertObservation()
+      self.pathIndex = np.zeros(0, np.intp)
 
 
    def iterator(self) :
       '''
-      Iterates through rebuilding the emission and transition matrices based on viterbi
+      Iterates through rebuilding the emission and transition matrices based
+      on viterbi, writing the model every saveEvery iterations with {0} in
+      the name of save replaced by the iteration number
       '''
-      for i in self.iteration:
+      for i in range(self.completed, self.iteration):
          self.viterbi()
          self.buildEmission()
          self.buildTransition()
-      self.printMatrices()
+         self.completed = i + 1
+         if self.save != '' and self.saveEvery and self.completed % self.saveEvery == 0:
+            self.saveModel(self.save.format(self.completed))
 
 
    def buildMatrix(self, matrixList) :
       '''
-      creates the numpy array of the matrix
+      creates the numpy array of the matrix, an array (such as the memory
+      mapped matrices of a ModelFile) is used as it is when it has the dtype
       '''
-
+      if isinstance(matrixList, np.ndarray):
+         return np.asarray(matrixList, self.dtype)
       m = []
       #iterate through, skipping the list and first item in each following list
       for i in range(1,len(matrixList)):
@@ -107,128 +335,160 @@ class HMM:
       #append new lines for each row of the matrix
       m = np.array(m)
       #set alll the values to float
-      matrix = m.astype(np.float)
+      matrix = m.astype(self.dtype)
       return matrix
 
 
    def convertOutput (self, outputIndex) :
       '''
-      iterate through output converting number to state based on index
+      looks up the state of each index in the output at once, as bytes when
+      every state is one character
       Returns the viterbi output converted into string of state charecters
       '''
-      output = ''
-      for i in outputIndex:
-         output += self.states[i]
-      return output
+      if all(len(state) == 1 for state in self.states):
+         return np.frombuffer(''.join(self.states).encode(), np.uint8)[outputIndex].tobytes().decode()
+      return ''.join(np.asarray(self.states)[outputIndex].tolist())
 
 
    def viterbi(self):
       '''
-      Returns the path of a given observation sequence using the viterbi algorithm
+      Finds the path of a given observation sequence using the viterbi algorithm,
+      stored as state indices in pathIndex
+      Note:
+         the scores are log probabilities so long paths do not underflow, only
+         the scores of the current position are kept and the backpointers are
+         stored in the smallest unsigned integer type that holds every state.
+         With a checkpoint the backpointers are not kept at all, the scores
+         are stored every checkpoint positions and each segment is recomputed
+         from its checkpoint during the traceback, which gives the same path
+         in O(k*(n/checkpoint + checkpoint)) memory
       '''
-      #convert observed sequence into an array of the indexed values
-      obsArray = np.array(self.convertObservation())
+      obsArray = self.obsArray #the observed sequence as indexed values
 
-      # sets prior probability as equal for all possible starting observations
-      prior = 1 / len(self.states)
+      k = len(self.states)
       #set to length of the obersation obsLen
-      obsLen = len(self.observation)
+      obsLen = len(self.obsArray)
 
-      #Initialize tracking tables of the needed dimensions
-      track1 = np.empty((len(self.states), obsLen))
-      track2 = np.empty((len(self.states), obsLen))
+      self.logMatrices()
 
-      #initialize tracking table1 with the prior probability
-      track1[:, 0] = prior * self.emission[:, obsArray[0]]
-      track2[:, 0] = 0
-      # Iterate throught the observations updating the tracking tables
-      for i in range(1, obsLen): #starting at 1 to avoid overindexing
-         track1[:, i] = np.max(track1[:, i - 1] * self.transition.T * self.emission[np.newaxis, :, obsArray[i]].T, 1)
-         track2[:, i] = np.argmax(track1[:, i - 1] * self.transition.T, 1)
+      #Initialize the scores with the prior probability
+      pointerType = np.min_scalar_type(k - 1)
+      track1 = self.logInitial + self.logEmission[obsArray[0]]
 
       # initialize the output array
-      x = np.empty(obsLen, 'B')
-      x[-1] = np.argmax(track1[:, obsLen - 1])
-      for i in reversed(range(1, obsLen)):
-         x[i - 1] = track2[x[i], i]
+      x = np.empty(obsLen, pointerType)
+
+      if self.checkpoint is None:
+         # Iterate throught the observations keeping every backpointer
+         track2 = np.empty((obsLen, k), pointerType)
+         track2[0] = 0
+         track1 = self.advance(track1, obsArray[1:], track2[1:])
+         x[-1] = np.argmax(track1)
+         for i in reversed(range(1, obsLen)):
+            x[i - 1] = track2[i, x[i]]
+
+      else:
+         every = self.checkpoint or int(np.ceil(np.sqrt(obsLen)))
+         checkpoints = np.empty(((obsLen - 1)//every + 1, k), self.dtype)
+         checkpoints[0] = track1
+         track1 = self.advance(track1, obsArray[1:], every=every, checkpoints=checkpoints)
+         x[-1] = np.argmax(track1)
 
-      self.path = self.convertOutput(x)  # converts from numbers back to state chars
+         # recompute the backpointers of one segment at a time, last first
+         track2 = np.empty((every, k), pointerType)
+         for c in reversed(range(len(checkpoints))):
+            start = c*every
+            end = min(start + every, obsLen - 1)
+            self.advance(checkpoints[c], obsArray[start + 1:end + 1], track2)
+            for i in reversed(range(start + 1, end + 1)):
+               x[i - 1] = track2[i - start - 1, x[i]]
+
+      self.pathIndex = x #convertOutput gives the state chars when they are printed
+
+
+   def logMatrices(self) :
+      '''
+      Stores the log of the matrices, impossible transitions and emissions
+      become -inf, and in sparse mode the nonzero transitions
+      '''
+      with np.errstate(divide='ignore'):
+         self.logTransition = np.log(self.transition)
+         self.logEmission = np.log(self.emission.T)
+         self.logInitial = np.log(self.initial)
+      if self.sparse:
+         self.sparseTransition = SparseTransition(self.transition)
+
+
+   def advance(self, track1, symbols, track2=None, every=0, checkpoints=None):
+      '''
+      Advances the viterbi log scores over the indexed symbols
+      Args:
+         track1: the scores at the position before the first symbol
+         symbols: the indexed observations to advance over
+         track2: an array with a row for each symbol to keep its backpointers
+         every: store the scores in checkpoints after every this many symbols
+         checkpoints: the array the scores are stored in, row 0 is track1
+      Returns:
+         the scores after the last symbol
+      '''
+      return self.kernels.viterbi(self, track1, symbols, track2, every, checkpoints)
 
 
 
    def convertObservation (self) :
       '''
-      iterate through observation storing alphabet index in list
-      Returns the numeric equivalent of the observation
+      Returns the numeric equivalent of the observation, reusing the codes of
+      an Observation
       '''
-      num = []
-      for i in self.observation:
-         num.append(self.alphabet.index(i))
-      return num
+      if isinstance(self.observation, Observation):
+         return self.observation.codes
+      return self.encoder.encode(self.observation)
 
 
-   def convertPath (self) :
+   def normalize(self, counts, previous=None) :
       '''
-      iterate through observation storing alphabet index in list
-      Returns the numeric equivalent of the observation
+      Converts each row of counts into probabilities, a state that was never
+      visited gets 1/k in every column or keeps its previous row if given
       '''
-      num = []
-      for i in self.path:
-         num.append(self.states.index(i))
-      return num
+      s = counts.sum(axis=1, keepdims=True) #sum the counts for each row
+      fill = 1/len(self.states) if previous is None else previous
+      return np.where(s > 0, counts/np.maximum(s, 1), fill).astype(self.dtype)
 
 
    def buildTransition (self) :
       '''
       builds the transition matrix based on the path and possible states
       '''
-      k =len(self.states)
-      m = [[0]*k]*k   #make list of lists from number of states
-      m = np.array(m)   #build np array from list of lists to hold counts
-      matrix = m.astype(np.float) #make matrix for holding probabilities
-      seq = self.convertPath()
-      
-      for x in range(len(seq)-1): #count each transition
-         m[seq[x]][seq[x+1]] += 1
-      
-      s = np.sum(m, axis = 1) #sum the counts for each row
-  
-      for i in range(k): #converts counts into probability
-         if s[i] == 0:
-            matrix[i] = [1/k] * k
-         else:
-            for j in range(k):
-               matrix[i, j] = m[i, j]/s[i]
+      k = len(self.states)
+      seq = self.pathIndex.astype(np.intp)
 
-      self.transition = matrix
+      #count each transition as the index previous*k + next
+      m = np.bincount(seq[:-1]*k + seq[1:], minlength=k*k).reshape(k, k)
+
+      #in sparse mode an unvisited state keeps its row so no transitions are added
+      self.transition = self.normalize(m, self.transition if self.sparse else None)
 
 
    def buildEmission (self) :
       '''
       builds the emission matrix based on the path and possible states
       '''
-      k =len(self.states)
-      l =len(self.alphabet)
+      k = len(self.states)
+      l = len(self.alphabet)
+      path = self.pathIndex.astype(np.intp)
 
-      m = [[0]*l]*k   #make list of lists from number of states
-      m = np.array(m)   #build np array from list of lists to hold counts
-      matrix = m.astype(np.float) #make matrix for holding probabilities
-      path = self.convertPath()
-      obs = self.convertObservation()
-      
-      for x in range(len(path)): #count each emission
-         m[path[x]][obs[x]] += 1
+      #count each emission as the index state*l + symbol
+      m = np.bincount(path*l + self.obsArray, minlength=k*l).reshape(k, l)
 
-      s = np.sum(m, axis = 1) #sum the counts for each row
+      self.emission = self.normalize(m)
 
-      for i in range(k): #converts counts into probability
-         if s[i] == 0:
-            matrix[i] = [1/k] * l
-         else:
-            for j in range(l):
-               matrix[i,j] = m[ i, j]/s[i]
 
-      self.emission = matrix
+   def saveModel (self, fname) :
+      '''
+      Writes the matrices, the prior and the iterations run to a ModelFile
+      '''
+      metadata = {'program': 'viterbiLearning', 'iterations': self.completed}
+      ModelFile(fname).write(self.states, self.alphabet, self.transition, self.emission, self.initial, metadata)
 
 
    def printMatrices (self) :
@@ -248,15 +508,312 @@ class HMM:
 
 
 
-def main() :
+class SparseTransition :
+   '''
+   Note:
+      Holds only the nonzero entries of a k x k transition matrix, in
+      compressed row (CSR) order and again in column order, so a product with
+      it costs the number of nonzero transitions instead of k*k. Banded and
+      profile models with thousands of mostly forbidden transitions gain the
+      most
+   Args:
+      matrix: the dense transition matrix
+   '''
+
+   def __init__(self, matrix) :
+      '''
+      Stores the nonzero entries and where each row and column starts
+      '''
+      self.k = len(matrix)
+      self.rows, self.cols = np.nonzero(matrix) #row major, so already in CSR order
+      self.values = matrix[self.rows, self.cols]
+      self.rowStarts = np.flatnonzero(np.diff(self.rows, prepend=-1))
+      self.rowIds = self.rows[self.rowStarts]
+
+      #the same entries ordered by column, rows still increasing within a column
+      order = np.argsort(self.cols, kind='stable')
+      self.colRows = self.rows[order]
+      self.colValues = self.values[order]
+      self.colStarts = np.flatnonzero(np.diff(self.cols[order], prepend=-1))
+      self.colIds = self.cols[order][self.colStarts]
+      self.colLogValues = np.log(self.colValues)
+      self.colSegment = np.repeat(np.arange(len(self.colStarts)), np.diff(np.append(self.colStarts, len(self.values))))
+
+
+   def maxProduct(self, track1) :
+      '''
+      Returns, for each state, the best of the log score track1[j] plus the log
+      transition from j over the nonzero transitions into it and the state j it
+      came from, the lowest j on ties as np.argmax would pick
+      '''
+      scores = np.full(self.k, -np.inf, track1.dtype)
+      best = np.zeros(self.k, np.intp)
+      if len(self.values):
+         candidates = track1[self.colRows] + self.colLogValues
+         top = np.maximum.reduceat(candidates, self.colStarts)
+         hit = np.flatnonzero(candidates == top[self.colSegment])
+         first = hit[np.diff(self.colSegment[hit], prepend=-1) != 0]
+         scores[self.colIds] = top
+         best[self.colIds] = self.colRows[first]
+      return scores, best
+
+
+class StreamDecoder :
+   '''
+   Note:
+      Decodes an unbounded stream of symbols with the viterbi algorithm of an
+      HMM in constant memory. A state is emitted as soon as every surviving
+      path agrees on it; when they have not agreed for 2*lag positions the
+      oldest lag positions are taken from the current best path, so a forced
+      decision always had at least lag positions of lookahead (and may not
+      join up with the path decided after it)
+   Args:
+      hmm: the HMM whose matrices are used
+      lag: the least lookahead of a forced decision
+   Returns:
+      Arrays of the state indices of consecutive positions
+   '''
+
+   def __init__(self, hmm, lag=1000) :
+      '''
+      Takes the log matrices of the hmm and allocates the backpointer buffer
+      '''
+      k = len(hmm.states)
+      hmm.logMatrices()
+      self.hmm = hmm
+      self.lag = max(lag, 1)
+      self.track2 = np.empty((2*self.lag, k), np.min_scalar_type(k - 1))
+
+
+   def readSymbols(self, fileH, chunkSize=1<<16) :
+      '''
+      Reads a binary file handle in chunks and yields the alphabet index of
+      each symbol, skipping whitespace. A buffered handle is read with read1,
+      which returns what a live pipe has so far instead of waiting for a
+      whole chunk
+      '''
+      read = getattr(fileH, 'read1', fileH.read)
+      while True:
+         chunk = read(chunkSize)
+         if not chunk:
+            return
+         yield self.hmm.encoder.encode(chunk)
+
+
+   def decode(self, chunks) :
+      '''
+      Advances the viterbi scores over each chunk of symbols and yields the
+      states that have been decided
+      '''
+      track1 = None
+      pending = 0   #positions not yet emitted, row 0 is the oldest
+      for symbols in chunks:
+         if track1 is None and len(symbols):
+            track1 = self.hmm.logInitial + self.hmm.logEmission[symbols[0]]
+            pending = 1
+            symbols = symbols[1:]
+         while len(symbols):
+            step = min(len(symbols), len(self.track2) - pending)
+            track1 = self.hmm.advance(track1, symbols[:step], self.track2[pending:pending + step])
+            track1 -= track1.max() #keeps the scores near zero, the path does not change
+            pending += step
+            symbols = symbols[step:]
+
+            states, pending = self.coalesce(pending)
+            if states is not None:
+               yield states
+            if pending == len(self.track2):
+               states = self.traceback(np.argmax(track1), pending)
+               yield states[:self.lag]
+               pending = self.shift(self.lag, pending)
+
+      if pending:
+         yield self.traceback(np.argmax(track1), pending)
+
+
+   def traceback(self, state, pending) :
+      '''
+      Returns the states of the pending positions ending in state
+      '''
+      x = np.empty(pending, self.track2.dtype)
+      x[-1] = state
+      for i in reversed(range(1, pending)):
+         x[i - 1] = self.track2[i, x[i]]
+      return x
+
+
+   def coalesce(self, pending) :
+      '''
+      Traces every state back at once to the newest position all the
+      surviving paths share and returns the states up to it
+      '''
+      paths = np.arange(self.track2.shape[1])
+      for i in reversed(range(1, pending)):
+         paths = self.track2[i, paths]
+         if (paths == paths[0]).all():
+            states = self.traceback(paths[0], i)
+            return states, self.shift(i, pending)
+      return None, pending
+
+
+   def shift(self, emitted, pending) :
+      '''
+      Drops the backpointers of the emitted positions from the buffer
+      '''
+      self.track2[:pending - emitted] = self.track2[emitted:pending]
+      return pending - emitted
+
+
+class NumpyKernels :
+   '''
+   Note:
+      The reference recursion, one NumPy call per position. It works with
+      dense and sparse transitions
+   '''
+
+   name = 'numpy'
+
+   def viterbi(self, hmm, track1, symbols, track2=None, every=0, checkpoints=None) :
+      '''
+      Advances the viterbi log scores over the symbols, as HMM.advance
+      '''
+      states = np.arange(len(hmm.states))
+      for i in range(len(symbols)):
+         if hmm.sparse:
+            track1, best = hmm.sparseTransition.maxProduct(track1)
+         else:
+            scores = track1[:, np.newaxis] + hmm.logTransition #scores[j, i] of moving from state j to i
+            best = np.argmax(scores, 0)
+            track1 = scores[best, states]
+         if track2 is not None:
+            track2[i] = best
+         track1 = track1 + hmm.logEmission[symbols[i]]
+         if hmm.dtype != np.float64:
+            track1 -= track1.max() #keeps single precision scores near zero, the path does not change
+         if every and (i + 1) % every == 0:
+            checkpoints[(i + 1)//every] = track1
+      return track1
+
+
+class LoopKernels :
+   '''
+   Note:
+      The recursion as plain loops over the states, compiled once with
+      Numba, so a position costs no Python calls. The additions and the
+      lowest index tie break are those of NumpyKernels, so the path is the
+      same. Only dense transition matrices are run this way
+   Args:
+      compile: the compiler of the loop function, numba.njit by default
+   '''
+
+   name = 'numba'
+
+   def __init__(self, compile=None) :
+      '''
+      Compiles the loop function
+      '''
+      compile = compile or numba.njit(cache=True)
+      self.viterbiLoop = compile(viterbiLoop)
+
+
+   def viterbi(self, hmm, track1, symbols, track2=None, every=0, checkpoints=None) :
+      '''the viterbi scores, as NumpyKernels.viterbi'''
+      k = len(hmm.states)
+      keep = track2 is not None
+      if track2 is None:
+         track2 = np.empty((0, k), np.min_scalar_type(k - 1))
+      if checkpoints is None:
+         checkpoints = np.empty((0, k), hmm.dtype)
+      return self.viterbiLoop(np.ascontiguousarray(hmm.logTransition), np.ascontiguousarray(hmm.logEmission),
+         np.array(track1, hmm.dtype), symbols, track2, keep, every, checkpoints, hmm.dtype != np.float64)
+
+
+def viterbiLoop(logTransition, logEmission, track1, symbols, track2, keep, every, checkpoints, rebase) :
+   '''
+   The viterbi recursion of NumpyKernels.viterbi as loops, track1 is
+   updated in place
+   '''
+   k = logTransition.shape[0]
+   scores = np.empty(k, track1.dtype)
+   for t in range(len(symbols)):
+      for i in range(k):
+         top = track1[0] + logTransition[0, i]
+         best = 0
+         for j in range(1, k):
+            score = track1[j] + logTransition[j, i]
+            if score > top:
+               top = score
+               best = j
+         scores[i] = top + logEmission[symbols[t], i]
+         if keep:
+            track2[t, i] = best
+      if rebase:
+         scores -= scores.max()
+      track1[:] = scores
+      if every and (t + 1) % every == 0:
+         checkpoints[(t + 1)//every] = track1
+   return track1
+
+
+def chooseKernels(backend='auto', sparse=False) :
+   '''
+   Returns the kernels of a backend: numpy, numba, or auto for numba when it
+   is installed. numba falls back to numpy, with a warning, without it or
+   for a sparse model, whose products only the numpy kernels run
+   '''
+   if sparse:
+      if backend == 'numba':
+         print('sparse models run on the numpy backend, ignoring --backend numba', file=sys.stderr)
+      return NumpyKernels()
+   if backend == 'numpy' or (backend == 'auto' and numba is None):
+      return NumpyKernels()
+   if numba is None:
+      print('numba is not installed, using the numpy backend', file=sys.stderr)
+      return NumpyKernels()
+   return LoopKernels()
+
+
+def main(myCommandLine=None) :
+
+   if myCommandLine is None:
+      myCommandLine = CommandLine()
 
    # read file and store as matrices
-   fileReader = FileReader('')
+   fileReader = FileReader(myCommandLine.args['model'])
    matrices = fileReader.readFile()
 
    # initialize hmm object and print the probability
-   hmm = HMM(matrices[0][0][0], matrices[1][0][0], matrices[2][0], matrices[3][0], matrices[4], matrices[5])
+   # a resumed model takes the place of the alphabet, states and matrix sections
+   model = ModelFile(myCommandLine.args['resume'])
+   if myCommandLine.args['resume'] != '':
+      model.read()
+      alphabet, states, transition, emission = model.alphabet, model.states, model.transition, model.emission
+   else:
+      alphabet, states, transition, emission = matrices[2][0], matrices[3][0], matrices[4], matrices[5]
+   if myCommandLine.args['observation'] != '':
+      observation = Observation(alphabet, fname=myCommandLine.args['observation'])
+   else:
+      observation = matrices[1][0][0]
+   hmm = HMM(int(matrices[0][0][0]), observation, alphabet, states, transition, emission,
+      checkpoint=myCommandLine.args['checkpoint'], sparse=myCommandLine.args['sparse'], initial=model.initial,
+      save=myCommandLine.args['save'], saveEvery=myCommandLine.args['save_every'],
+      dtype=np.float32 if myCommandLine.args['precision'] == 32 else np.float64,
+      backend=myCommandLine.args['backend'])
+   hmm.completed = model.metadata.get('iterations', 0)
    hmm.iterator()
+   if myCommandLine.args['save'] != '':
+      hmm.saveModel(myCommandLine.args['save'].format(hmm.completed))
+
+   if not myCommandLine.args['stream']:
+      hmm.printMatrices()
+      return
+
+   # decode stdin with the learned matrices, writing states as they are decided
+   decoder = StreamDecoder(hmm, myCommandLine.args['lag'])
+   for states in decoder.decode(decoder.readSymbols(sys.stdin.buffer)):
+      sys.stdout.write(hmm.convertOutput(states))
+      sys.stdout.flush() #a reader of a pipe sees the states as they are decided
+   sys.stdout.write('\n')
 
 
 if __name__ == "__main__":